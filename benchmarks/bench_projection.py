@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Benchmark of dropping unselected properties in the tap | target pipe (--drop-unselected).
+
+Synthesizes RECORD messages carrying every property of the selected streams of a catalog
+(as taps which ignore property selection do) and reports bytes passed to the target with
+and without the projection stage, e.g.:
+
+    python benchmarks/bench_projection.py --catalog taps/tap-adwords/catalog.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from singer_aws import pipe
+from singer_aws.catalog import allowed_properties, catalog_index, load_catalog
+
+
+def synthesize(catalog, allowed, records, value_size):
+    """
+    Messages of a sync: a SCHEMA and `records` RECORD messages per selected stream.
+    """
+
+    value = "x" * value_size
+    lines = []
+    for stream in catalog['streams']:
+        name = stream['tap_stream_id']
+        if name not in allowed:
+            continue
+        properties = stream['schema'].get('properties', {})
+        lines.append(json.dumps({"type": "SCHEMA", "stream": name, "schema": stream['schema'],
+                                 "key_properties": []}).encode() + b"\n")
+        for i in range(records):
+            record = {key: value for key in properties}
+            lines.append(json.dumps({"type": "RECORD", "stream": name, "record": record}).encode() + b"\n")
+    return(lines)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark of --drop-unselected projection stage.')
+    parser.add_argument('--catalog', default='taps/tap-adwords/catalog.json')
+    parser.add_argument('--records', type=int, default=20000, help='RECORD messages per selected stream.')
+    parser.add_argument('--value-size', type=int, default=12, help='Length of every property value.')
+    args = parser.parse_args()
+
+    catalog = load_catalog(args.catalog)
+    allowed = allowed_properties(catalog_index(args.catalog))
+    lines = synthesize(catalog, allowed, args.records, args.value_size)
+
+    stage = pipe.ProjectStage('bench', allowed)
+    start = time.perf_counter()
+    out = [line for message in lines for line in stage.process(message)]
+    elapsed = time.perf_counter() - start
+
+    bytes_in = sum(len(line) for line in lines)
+    bytes_out = sum(len(line) for line in out)
+
+    print(json.dumps({
+        "catalog": args.catalog,
+        "codec": "orjson" if pipe.orjson is not None else "json",
+        "streams": len(allowed),
+        "messages": len(lines),
+        "bytes_in": bytes_in,
+        "bytes_out": bytes_out,
+        "bytes_reduction": round(1 - bytes_out / bytes_in, 4),
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round(len(lines) / elapsed),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
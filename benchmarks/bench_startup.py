@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Benchmark of startup time of singer-aws commands: time to import every entry point module
+in a fresh interpreter (and which of boto3 / yaml / asyncio are imported by it; asyncio
+is needed by every command running a pipeline, see singer_aws.engine), and time to load
+singer_project_config.yml in a fresh interpreter with a cold and a warm cache, e.g.:
+
+    python benchmarks/bench_startup.py --project-config singer_project_config.yml
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PACKAGE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+ENTRY_POINTS = [
+    'singer_aws.main',
+    'singer_aws.sync_all',
+    'singer_aws.discover',
+    'singer_aws.inspect_catalog',
+    'singer_aws.install_venvs',
+    'singer_aws.replay',
+    'singer_aws.worker',
+]
+
+# modules whose import cost is worth knowing about
+HEAVY_MODULES = ['boto3', 'yaml', 'asyncio']
+
+
+def run_python(code, env):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", code], env=env, stdout=subprocess.PIPE, check=True)
+    return(time.perf_counter() - start, result.stdout.decode())
+
+
+def timings(code, env, runs):
+    seconds = [run_python(code, env)[0] for _ in range(runs)]
+    return({
+        "min_ms": round(min(seconds) * 1000, 1),
+        "median_ms": round(statistics.median(seconds) * 1000, 1),
+    })
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark of startup time of singer-aws commands.')
+    parser.add_argument('--project-config', default=os.path.join(PACKAGE_PATH, 'singer_project_config.yml'))
+    parser.add_argument('--runs', type=int, default=10, help='Runs of every measurement.')
+    args = parser.parse_args()
+
+    cache = tempfile.mkdtemp(prefix="singer-aws-bench-cache-")
+    env = dict(os.environ, PYTHONPATH=PACKAGE_PATH, SINGER_AWS_CACHE_DIR=cache)
+
+    results = {"interpreter": timings("pass", env, args.runs), "imports": {}}
+    for module in ENTRY_POINTS:
+        _, heavy = run_python(
+            f"import json, sys, {module}; print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))", env)
+        results["imports"][module] = dict(timings(f"import {module}", env, args.runs), imports=json.loads(heavy))
+    results["imports"]["asyncio"] = timings("import asyncio", env, args.runs)
+
+    load = (f"from singer_aws.project_config import load_project_config; "
+            f"load_project_config({args.project_config!r})")
+    cold = [run_python(f"import shutil; shutil.rmtree({cache!r}, ignore_errors=True); {load}", env)[0]
+            for _ in range(args.runs)]
+    results["load_project_config"] = {
+        "cold_cache_median_ms": round(statistics.median(cold) * 1000, 1),
+        "warm_cache": timings(load, env, args.runs),
+    }
+
+    shutil.rmtree(cache, ignore_errors=True)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""
+End to end benchmark of singer-aws-sync: runs the real singer-aws-sync command (project
+config, SSM, STS, state in S3, tap | target pipe) with a synthetic tap and a sink target,
+against local stand-ins of S3, SSM and STS (moto, `pip install moto`).
+
+The synthetic tap emits --records RECORD messages spread over --streams streams, each
+record with --record-width bytes of payload, and a STATE message every --state-every
+records. The sink target only parses messages and echoes states. Reported per run:
+throughput of the pipe, peak RSS of singer-aws and of its subprocesses, and time of every
+phase of the run (see singer_aws.report), e.g.:
+
+    python benchmarks/bench_sync.py --records 200000 --streams 4 --runs 3 -- --meter
+
+Arguments after `--` are passed to singer-aws-sync. The first run is cold (STS, SSM and
+S3 clients are created), subsequent runs reuse them. Peak RSS is measured with getrusage,
+so RSS of singer-aws includes moto, and RSS of subprocesses is never lower than RSS of
+singer-aws when they were forked.
+"""
+import argparse
+import glob
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+TAP = """#!{python}
+import json, sys
+config = json.load(open(sys.argv[sys.argv.index("--config") + 1]))
+streams = ["stream_%d" % i for i in range(config["streams"])]
+payload = "x" * config["record_width"]
+out = sys.stdout
+for stream in streams:
+    out.write(json.dumps({{"type": "SCHEMA", "stream": stream, "key_properties": ["id"],
+                          "schema": {{"properties": {{"id": {{"type": "integer"}}, "payload": {{"type": "string"}}}}}}}}) + "\\n")
+for i in range(config["records"]):
+    stream = streams[i % len(streams)]
+    out.write(json.dumps({{"type": "RECORD", "stream": stream, "record": {{"id": i, "payload": payload}}}}) + "\\n")
+    if (i + 1) % config["state_every"] == 0:
+        out.write(json.dumps({{"type": "STATE", "value": {{"bookmarks": {{stream: {{"id": i}}}}}}}}) + "\\n")
+out.write(json.dumps({{"type": "STATE", "value": {{"bookmarks": {{s: {{"id": config["records"]}} for s in streams}}}}}}) + "\\n")
+"""
+
+TARGET = """#!{python}
+import json, sys
+for line in sys.stdin:
+    message = json.loads(line)
+    if message["type"] == "STATE":
+        sys.stdout.write(json.dumps(message["value"]) + "\\n")
+        sys.stdout.flush()
+"""
+
+PROJECT_CONFIG = """
+data_bucket: bench-bucket
+redshift_iam_role: arn:aws:iam::123456789012:role/bench
+ssm_prefix: /bench
+taps:
+  tap-bench:
+    catalog_arg: --catalog
+    schema: bench
+targets:
+  target-bench:
+    config_param: dummy
+"""
+
+
+def write_executable(path, code):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as fh:
+        fh.write(code.format(python=sys.executable))
+    os.chmod(path, 0o755)
+
+
+def make_project(path, args):
+    """
+    Create a singer project with the synthetic tap & target in path.
+    """
+
+    write_executable(os.path.join(path, "venv/tap-bench/bin/tap-bench"), TAP)
+    write_executable(os.path.join(path, "venv/target-bench/bin/target-bench"), TARGET)
+    os.makedirs(os.path.join(path, "targets/target-bench"))
+    os.makedirs(os.path.join(path, "taps/tap-bench"))
+    with open(os.path.join(path, "singer_project_config.yml"), 'w') as fh:
+        fh.write(PROJECT_CONFIG)
+
+    streams = []
+    for i in range(args.streams):
+        streams.append({
+            "tap_stream_id": f"stream_{i}",
+            "stream": f"stream_{i}",
+            "key_properties": ["id"],
+            "schema": {"properties": {"id": {"type": "integer"}, "payload": {"type": "string"}}},
+            "metadata": [{"breadcrumb": [], "metadata": {"selected": True}}],
+        })
+    with open(os.path.join(path, "taps/tap-bench/catalog.json"), 'w') as fh:
+        json.dump({"streams": streams}, fh)
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux
+    return(round(resource.getrusage(who).ru_maxrss / 1024, 1))
+
+
+def pipe_seconds(report):
+    """
+    Wall-clock time of tap | target processes of a run, from the start of the first one to the
+    end of the last one (backfills and --partition-targets runs record a tap_target:<part> phase each).
+    """
+
+    phases = [phase for phase in report["phases"] if phase["name"].split(":")[0] == "tap_target"]
+    return(max(phase["start_seconds"] + phase["seconds"] for phase in phases)
+           - min(phase["start_seconds"] for phase in phases))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='End to end benchmark of singer-aws-sync.')
+    parser.add_argument('--records', type=int, default=100000, help='RECORD messages emitted by the tap.')
+    parser.add_argument('--streams', type=int, default=4, help='Streams the records are spread over.')
+    parser.add_argument('--record-width', type=int, default=200, help='Bytes of payload of every record.')
+    parser.add_argument('--state-every', type=int, default=1000, help='RECORD messages between STATE messages.')
+    parser.add_argument('--runs', type=int, default=3, help='Number of runs.')
+    parser.add_argument('sync_args', nargs='*', help='Arguments passed to singer-aws-sync (after --).')
+    args = parser.parse_args()
+
+    try:
+        from moto import mock_aws
+    except ImportError:
+        print("moto is required to run this benchmark: pip install moto")
+        sys.exit(1)
+
+    project_path = tempfile.mkdtemp(prefix="singer-aws-bench-")
+    make_project(project_path, args)
+    # singer_aws modules resolve paths of the project from the working directory on import
+    os.chdir(project_path)
+    os.environ.update({
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "SINGER_AWS_CACHE_DIR": os.path.join(project_path, "cache"),
+    })
+
+    tap_config = {
+        "records": args.records,
+        "streams": args.streams,
+        "record_width": args.record_width,
+        "state_every": args.state_every,
+    }
+
+    results = []
+    try:
+        with mock_aws():
+            import boto3
+            boto3.client("s3").create_bucket(Bucket="bench-bucket")
+            ssm = boto3.client("ssm")
+            ssm.put_parameter(Name="/bench/TAP_BENCH_CONFIG", Value=json.dumps(tap_config), Type="SecureString")
+            ssm.put_parameter(Name="/bench/TARGET_BENCH_CONFIG", Value=json.dumps({"target_s3": {}}), Type="SecureString")
+
+            from singer_aws import main as sync_main
+
+            for run in range(args.runs):
+                sys.argv = ["singer-aws-sync", "--tap", "bench", "--target", "bench", "--report"] + args.sync_args
+                start = time.perf_counter()
+                sync_main.main()
+                elapsed = time.perf_counter() - start
+
+                report_path = max(glob.glob(os.path.join(project_path, "reports/*.json")), key=os.path.getmtime)
+                with open(report_path) as fh:
+                    report = json.load(fh)
+                os.remove(report_path)
+
+                results.append({
+                    "run": run + 1,
+                    "seconds": round(elapsed, 3),
+                    "records_per_second": round(args.records / pipe_seconds(report)),
+                    "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF),
+                    "peak_rss_subprocesses_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+                    "phases": {name: total["seconds"] for name, total in report["totals"].items()},
+                    "relay": {key: value for key, value in report.items() if key.split(":")[0] == "relay"},
+                })
+    finally:
+        os.chdir("/")
+        shutil.rmtree(project_path, ignore_errors=True)
+
+    print(json.dumps({
+        "records": args.records,
+        "streams": args.streams,
+        "record_width": args.record_width,
+        "state_every": args.state_every,
+        "sync_args": args.sync_args,
+        "runs": results,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
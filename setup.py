@@ -13,9 +13,12 @@ setup(
     '''
     [console_scripts]
       singer-aws-sync=singer_aws.main:main
+      singer-aws-sync-all=singer_aws.sync_all:main
       singer-aws-discover=singer_aws.discover:main
       singer-aws-install=singer_aws.install_venvs:main
       singer-aws-inspect=singer_aws.inspect_catalog:main
+      singer-aws-replay=singer_aws.replay:main
+      singer-aws-worker=singer_aws.worker:main
     ''',
     packages=["singer_aws"],
     include_package_data=True,
@@ -0,0 +1,155 @@
+from datetime import datetime, timezone
+import hashlib
+import json
+import logging
+import os
+import random
+from singer_aws.cache import cache_dir, write_private
+from singer_aws.report import phase
+import string
+import threading
+
+"""
+Process-wide AWS sessions and clients. A session is created once per AWS profile
+(or assumed IAM role) and its clients are reused by every caller, so that a single
+singer-aws run assumes a role only once. Assumed-role credentials are refreshed
+shortly before they expire and cached on disk, to be reused by subsequent runs
+in the same container until they expire.
+
+boto3 is imported on first use, as importing it takes a good part of the startup time
+of commands which may not need it at all (e.g. when state is ignored and configs are
+read from files).
+"""
+
+# assumed-role credentials are refreshed this many seconds before they expire
+REFRESH_MARGIN_SECONDS = 300
+
+# clients are shared between threads (e.g. state checkpoints, concurrent pipelines)
+MAX_POOL_CONNECTIONS = 32
+
+_lock = threading.RLock()
+_sessions = {}
+_clients = {}
+
+
+def _credentials_path(iam_role_arn):
+    name = hashlib.sha256(iam_role_arn.encode()).hexdigest()[:16]
+    return(os.path.join(cache_dir('credentials'), f"{name}.json"))
+
+
+def _is_fresh(credentials):
+    expiration = datetime.fromisoformat(credentials['Expiration'])
+    return((expiration - datetime.now(timezone.utc)).total_seconds() > REFRESH_MARGIN_SECONDS)
+
+
+def _read_cached_credentials(iam_role_arn):
+    try:
+        with open(_credentials_path(iam_role_arn)) as fh:
+            credentials = json.load(fh)
+    except (OSError, ValueError):
+        return(None)
+    return(credentials if _is_fresh(credentials) else None)
+
+
+def assume_role(iam_role_arn):
+    """
+    Assume an IAM role, returning its credentials (with Expiration as ISO string).
+    Credentials cached on disk are returned instead, as long as they're not about to expire.
+    """
+
+    credentials = _read_cached_credentials(iam_role_arn)
+    if credentials is not None:
+        logging.info(f"using cached credentials of {iam_role_arn}.")
+        return(credentials)
+
+    import boto3
+
+    with phase("sts_assume_role"):
+        sts_client = boto3.client("sts")
+        uid = "".join(random.choice(string.hexdigits) for n in range(8))
+        response = sts_client.assume_role(RoleArn=iam_role_arn, RoleSessionName=f"singer_{uid}")
+
+    credentials = response["Credentials"]
+    credentials = {
+        "AccessKeyId": credentials["AccessKeyId"],
+        "SecretAccessKey": credentials["SecretAccessKey"],
+        "SessionToken": credentials["SessionToken"],
+        "Expiration": credentials["Expiration"].astimezone(timezone.utc).isoformat(),
+    }
+
+    try:
+        write_private(_credentials_path(iam_role_arn), json.dumps(credentials))
+    except OSError:
+        logging.warning(f"credentials of {iam_role_arn} couldn't be cached on disk.")
+
+    return(credentials)
+
+
+def client_config():
+    """
+    botocore config of shared clients.
+    """
+
+    from botocore.config import Config
+
+    return(Config(max_pool_connections=MAX_POOL_CONNECTIONS))
+
+
+def session(aws_profile=None, iam_role_arn=None):
+    """
+    Return a shared boto3 session: sourced from aws_profile if passed, from assumed
+    iam_role_arn if passed, from default credentials chain otherwise.
+    """
+
+    import boto3
+
+    key = (aws_profile, iam_role_arn)
+
+    with _lock:
+        entry = _sessions.get(key)
+        if entry is not None and (entry['credentials'] is None or _is_fresh(entry['credentials'])):
+            return(entry['session'])
+
+        credentials = None
+        if aws_profile is not None:
+            new_session = boto3.Session(profile_name=aws_profile)
+        elif iam_role_arn is not None:
+            credentials = assume_role(iam_role_arn)
+            new_session = boto3.Session(
+                aws_access_key_id=credentials["AccessKeyId"],
+                aws_secret_access_key=credentials["SecretAccessKey"],
+                aws_session_token=credentials["SessionToken"],
+            )
+        else:
+            new_session = boto3.Session()
+
+        _sessions[key] = {'session': new_session, 'credentials': credentials}
+        # clients of a refreshed session would keep using the expired credentials
+        for client_key in [k for k in _clients if k[:2] == key]:
+            del _clients[client_key]
+
+        return(new_session)
+
+
+def client(service, aws_profile=None, iam_role_arn=None):
+    """
+    Return a shared boto3 client of a given service (clients are thread-safe).
+    """
+
+    with _lock:
+        current_session = session(aws_profile, iam_role_arn)
+        key = (aws_profile, iam_role_arn, service)
+        if key not in _clients:
+            _clients[key] = current_session.client(service, config=client_config())
+        return(_clients[key])
+
+
+def resource(service, aws_profile=None, iam_role_arn=None):
+    """
+    Return a boto3 resource of a given service, created from the shared session.
+    Resources are not thread-safe, so a new one is returned on every call.
+    """
+
+    with _lock:
+        current_session = session(aws_profile, iam_role_arn)
+        return(current_session.resource(service, config=client_config()))
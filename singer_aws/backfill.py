@@ -0,0 +1,153 @@
+from datetime import datetime, timezone
+import json
+import logging
+import os
+from singer_aws import engine
+from singer_aws.pipe import build_stages
+from singer_aws.sync import merge_states, prune_states, run_sync, send_state, singer_home
+
+"""
+Backfill of a tap (a run with --ignore-state) split into time windows: the range between
+`start_date` of the tap config and now is split into N consecutive windows, and each window
+is replicated by a separate "tap | target" pipeline, up to --backfill-concurrency at a time,
+all of them on a single event loop (see singer_aws.engine.run_many).
+
+Every window runs with its own tap config (start_date & end_date of the window), stored in
+taps/tap-name/backfill/, and its own state file. States are not uploaded while windows run;
+once all of them succeed, their final states are merged (later windows win) and uploaded as
+a single state, so that the next incremental run resumes from the end of the backfill.
+
+Names of start & end date properties default to start_date & end_date, and can be changed
+with `backfill_start_key` & `backfill_end_key` properties of a tap in singer_project_config.yml.
+Taps which don't support an end date property would replicate everything since start of their
+window in every window, so backfill only makes sense for taps which do.
+"""
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def parse_date(value):
+    """
+    Parse a date(time) of a tap config, e.g. 2020-01-01 or 2020-01-01T00:00:00Z, as UTC.
+    """
+
+    date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return(date)
+
+
+def split_windows(start, end, windows):
+    """
+    Split range between start and end into `windows` consecutive (start, end) pairs of equal length.
+    """
+
+    if windows < 1:
+        raise ValueError(f"ERROR: number of backfill windows must be positive, got {windows}.")
+    if end <= start:
+        raise ValueError(f"ERROR: backfill start date {start} is not before its end date {end}.")
+
+    step = (end - start) / windows
+    bounds = [start + step * i for i in range(windows)] + [end]
+    return(list(zip(bounds[:-1], bounds[1:])))
+
+
+def write_window_configs(tap, project_config, windows):
+    """
+    Write a tap config per window to taps/tap-name/backfill/window-N.json, based on taps/tap-name/config.json.
+    Returns list of (window name, config path relative to singer_home, start, end).
+    """
+
+    tap_options = project_config['taps'].get(f"tap-{tap}") or {}
+    start_key = tap_options.get('backfill_start_key', 'start_date')
+    end_key = tap_options.get('backfill_end_key', 'end_date')
+
+    with open(os.path.join(singer_home, f"taps/tap-{tap}/config.json")) as fh:
+        tap_config = json.load(fh)
+
+    if not tap_config.get(start_key):
+        raise ValueError(f"ERROR: config of tap-{tap} has no {start_key} property to split into windows.")
+    start = parse_date(tap_config[start_key])
+    end = parse_date(tap_config[end_key]) if tap_config.get(end_key) else datetime.now(timezone.utc)
+
+    backfill_path = os.path.join(singer_home, f"taps/tap-{tap}/backfill")
+    os.makedirs(backfill_path, exist_ok=True)
+
+    configs = []
+    for i, (window_start, window_end) in enumerate(split_windows(start, end, windows)):
+        name = f"window-{i:03d}"
+        window_config = dict(tap_config)
+        window_config[start_key] = window_start.strftime(DATE_FORMAT)
+        window_config[end_key] = window_end.strftime(DATE_FORMAT)
+        path = f"taps/tap-{tap}/backfill/{name}.json"
+        # tap configs hold credentials
+        fd = os.open(os.path.join(singer_home, path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(window_config, fh)
+        configs.append((name, path, window_start, window_end))
+
+    return(configs)
+
+
+def cleanup_window_configs(tap):
+    """
+    Remove tap configs of backfill windows (they hold credentials).
+    """
+
+    backfill_path = os.path.join(singer_home, f"taps/tap-{tap}/backfill")
+    if not os.path.isdir(backfill_path):
+        return
+    for name in os.listdir(backfill_path):
+        os.remove(os.path.join(backfill_path, name))
+    os.rmdir(backfill_path)
+
+
+def backfill(tap, target, project_config, bucket, args, windows, concurrency, aws_profile=None,
+             target_config_path=None):
+    """
+    Run a backfill of a tap split into `windows` time windows, up to `concurrency` windows at a time.
+    Uploads merged state of all windows to S3 only if every window succeeded.
+    """
+
+    # fail before any window starts if stages can't be built (e.g. --spool)
+    build_stages(f"tap-{tap}", project_config, args, part="window")
+    configs = write_window_configs(tap, project_config, windows)
+    logging.info(f"RUNNING: backfill of tap-{tap} in {len(configs)} windows, up to {concurrency} at a time.")
+
+    async def run(name, path, window_start, window_end):
+        logging.info(f"RUNNING: tap-{tap} {name} from {window_start.strftime(DATE_FORMAT)} "
+                     f"to {window_end.strftime(DATE_FORMAT)}.")
+        stages = build_stages(f"tap-{tap}", project_config, args, part=name)
+        states = await run_sync(tap, target, project_config, bucket, True, aws_profile,
+                                target_config_path=target_config_path, stages=stages, tap_config_path=path,
+                                part=name, send_states=False, prune_catalog=getattr(args, 'prune_catalog', None),
+                                timeout=getattr(args, 'timeout_seconds', None))
+        return(states[target])
+
+    try:
+        results = []
+        for (name, _, _, _), result in zip(configs, engine.run_many([run(*config) for config in configs], concurrency)):
+            if isinstance(result, BaseException):
+                # SystemExit included, raised by sync when e.g. S3 is not reachable
+                logging.error(f"ERROR: tap-{tap} backfill {name} failed: {result!r}")
+                results.append((name, None, result))
+            else:
+                results.append((name, result, None))
+    finally:
+        cleanup_window_configs(tap)
+
+    failed = [name for name, _, exc in results if exc is not None]
+    if failed:
+        raise ValueError(f"ERROR: tap-{tap} backfill windows failed: {', '.join(failed)}; state is not updated.")
+
+    # windows are listed chronologically, so bookmarks of later windows win
+    states = [json.loads(state) for _, state, _ in results if state is not None]
+    if not states:
+        logging.info(f"SUCCESS: tap-{tap} backfill succeeded, no state emitted by target-{target}.")
+        return
+
+    send_state(f"tap-{tap}", project_config, bucket, aws_profile, state=json.dumps(merge_states(states)))
+    state_retention = project_config.get('state_retention')
+    if state_retention:
+        prune_states(f"tap-{tap}", project_config, bucket, state_retention, aws_profile)
+    logging.info(f"SUCCESS: tap-{tap} backfill of {len(configs)} windows succeeded, merged state uploaded.")
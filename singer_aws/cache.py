@@ -0,0 +1,28 @@
+import os
+
+"""
+Local cache of singer-aws (e.g. assumed-role credentials). Located in
+SINGER_AWS_CACHE_DIR env variable if set, ~/.cache/singer-aws otherwise.
+"""
+
+def cache_dir(*parts):
+    """
+    Return path of a (sub)directory of the local singer-aws cache, creating it if needed.
+    """
+
+    root = os.getenv('SINGER_AWS_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'singer-aws')
+    path = os.path.join(root, *parts)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return(path)
+
+
+def write_private(path, data):
+    """
+    Atomically write data (str) to a file readable only by the current user.
+    """
+
+    path_tmp = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(path_tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as fh:
+        fh.write(data)
+    os.replace(path_tmp, path)
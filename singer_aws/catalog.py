@@ -0,0 +1,287 @@
+"""
+Helpers reading selection of streams and properties from Singer catalogs
+(taps/tap-name/catalog.json), following Singer metadata rules: a property is
+selected if its inclusion is `automatic`, or if it's marked as `selected`, or
+(when `selected` is not set) if it's `selected-by-default`.
+
+Catalogs of some taps have tens of thousands of lines, so instead of walking
+a catalog every time, its compiled index (see compile_catalog) is cached in
+memory and on disk, and rebuilt only when the catalog file changes. For the same
+reason, taps can be handed a pruned catalog (see prune_catalog) instead of the full one.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+from singer_aws.cache import cache_dir
+import logging
+import tempfile
+import threading
+
+# bump when structure of compiled index changes, to invalidate indexes cached on disk
+INDEX_VERSION = 1
+
+# bump when prune_catalog changes, to invalidate pruned catalogs cached on disk
+PRUNE_VERSION = 1
+
+_index_lock = threading.Lock()
+_indexes = {}
+
+def load_catalog(path):
+    """
+    Read a Singer catalog file.
+    """
+
+    with open(path) as catalog_file:
+        return(json.load(catalog_file))
+
+
+def metadata_by_breadcrumb(stream):
+    """
+    Map breadcrumb (as tuple) to metadata of a catalog stream.
+    """
+
+    return({tuple(item['breadcrumb']): item.get('metadata', {}) for item in stream.get('metadata', [])})
+
+
+def is_selected(metadata):
+    """
+    Whether a stream or property with given metadata is selected for replication.
+    """
+
+    if metadata.get('inclusion') == 'automatic':
+        return(True)
+    if metadata.get('inclusion') == 'unsupported':
+        return(False)
+    if 'selected' in metadata:
+        return(bool(metadata['selected']))
+    return(bool(metadata.get('selected-by-default', False)))
+
+
+def selected_properties(stream):
+    """
+    Names of top-level properties of a catalog stream selected for replication,
+    or None if the catalog doesn't select properties of the stream at all
+    (in which case taps replicate all of them).
+    """
+
+    selection_keys = ('selected', 'inclusion', 'selected-by-default')
+    properties = [
+        (breadcrumb[1], metadata) for breadcrumb, metadata in metadata_by_breadcrumb(stream).items()
+        if len(breadcrumb) == 2 and breadcrumb[0] == 'properties'
+        ]
+
+    if not any(key in metadata for _, metadata in properties for key in selection_keys):
+        return(None)
+
+    return(frozenset(name for name, metadata in properties if is_selected(metadata)))
+
+
+def compile_catalog(catalog):
+    """
+    Compile a catalog into an index of its streams by tap_stream_id, holding everything
+    singer-aws needs to know about a stream without walking its metadata again.
+    """
+
+    streams = {}
+    for stream in catalog['streams']:
+        metadata = metadata_by_breadcrumb(stream)
+        stream_metadata = metadata.get((), {})
+        properties = list(stream.get('schema', {}).get('properties', {}).keys())
+        selected = selected_properties(stream)
+        streams[stream['tap_stream_id']] = {
+            "stream": stream.get('stream', stream['tap_stream_id']),
+            "selected": is_selected(stream_metadata),
+            "properties": properties,
+            # None == catalog doesn't select properties of this stream
+            "selected_properties": None if selected is None else frozenset(selected),
+            "selected_properties_list": None if selected is None else [name for name in properties if name in selected],
+            # properties explicitly marked as selected in the catalog (regardless of stream selection)
+            "marked_properties_list": [
+                breadcrumb[1] for breadcrumb, item in metadata.items()
+                if len(breadcrumb) == 2 and breadcrumb[0] == 'properties' and item.get('selected')
+                ],
+            "key_properties": stream_metadata.get('table-key-properties', stream.get('key_properties', [])),
+            "replication_method": stream_metadata.get('forced-replication-method', stream.get('replication_method')),
+            "replication_key": stream_metadata.get('replication-key', stream.get('replication_key')),
+            "valid_replication_keys": stream_metadata.get('valid-replication-keys', []),
+        }
+
+    return({"version": INDEX_VERSION, "streams": streams})
+
+
+def _index_cache_path(path):
+    name = hashlib.sha256(os.path.realpath(path).encode()).hexdigest()[:32]
+    return(os.path.join(cache_dir('catalogs'), f"{name}.pickle"))
+
+
+def catalog_index(path):
+    """
+    Compiled index of a catalog file (see compile_catalog), cached in memory and on disk
+    and invalidated when modification time or size of the catalog file changes.
+    """
+
+    stat = os.stat(path)
+    signature = (INDEX_VERSION, stat.st_mtime_ns, stat.st_size)
+    key = os.path.realpath(path)
+
+    with _index_lock:
+        cached = _indexes.get(key)
+        if cached is not None and cached[0] == signature:
+            return(cached[1])
+
+        cache_path = _index_cache_path(path)
+        index = None
+        try:
+            with open(cache_path, 'rb') as fh:
+                cached_signature, cached_index = pickle.load(fh)
+            if cached_signature == signature:
+                index = cached_index
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            pass
+
+        if index is None:
+            index = compile_catalog(load_catalog(path))
+            try:
+                path_tmp = f"{cache_path}.{os.getpid()}.tmp"
+                with open(path_tmp, 'wb') as fh:
+                    pickle.dump((signature, index), fh, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(path_tmp, cache_path)
+            except OSError:
+                pass
+
+        _indexes[key] = (signature, index)
+        return(index)
+
+
+def allowed_properties(index):
+    """
+    Map stream name (as found in `stream` of Singer messages) to selected properties
+    of the stream, for every selected stream of a compiled catalog whose properties are selected.
+    """
+
+    allowed = {}
+    for tap_stream_id, stream in index['streams'].items():
+        if not stream['selected'] or stream['selected_properties'] is None:
+            continue
+        for name in set([tap_stream_id, stream['stream']]):
+            allowed[name] = stream['selected_properties']
+
+    return(allowed)
+
+
+def prune_catalog(catalog):
+    """
+    Minimal catalog replicating the same data: selected streams only, and (for streams
+    whose catalog selects properties) only selected, automatic, key and replication key
+    properties, in both schema and metadata.
+    """
+
+    streams = []
+    for stream in catalog.get('streams', []):
+        metadata = metadata_by_breadcrumb(stream)
+        stream_metadata = metadata.get((), {})
+        if not is_selected(stream_metadata):
+            continue
+        selected = selected_properties(stream)
+        if selected is None:
+            streams.append(stream)
+            continue
+
+        keep = set(selected)
+        keep.update(stream_metadata.get('table-key-properties', stream.get('key_properties', [])) or [])
+        replication_key = stream_metadata.get('replication-key', stream.get('replication_key'))
+        if replication_key:
+            keep.add(replication_key)
+
+        stream = dict(stream)
+        schema = stream['schema'] = dict(stream.get('schema', {}))
+        schema['properties'] = {name: value for name, value in schema.get('properties', {}).items() if name in keep}
+        if 'required' in schema:
+            schema['required'] = [name for name in schema['required'] if name in keep]
+        stream['metadata'] = [
+            item for item in stream.get('metadata', [])
+            if len(item['breadcrumb']) < 2 or item['breadcrumb'][0] != 'properties' or item['breadcrumb'][1] in keep
+            ]
+        streams.append(stream)
+
+    return(dict(catalog, streams=streams))
+
+
+def pruned_catalog_path(path):
+    """
+    Path of the pruned version (see prune_catalog) of a catalog file, written to the local
+    cache under the hash of the catalog, so that it's rebuilt only when the catalog changes.
+    """
+
+    with open(path, 'rb') as fh:
+        content = fh.read()
+    digest = hashlib.sha256(content + f"{PRUNE_VERSION}".encode()).hexdigest()[:32]
+    pruned_path = os.path.join(cache_dir('pruned_catalogs'), f"{digest}.json")
+    if os.path.exists(pruned_path):
+        return(pruned_path)
+
+    catalog = json.loads(content)
+    pruned = json.dumps(prune_catalog(catalog))
+    # unique, as taps with the same catalog may be pruned at once, e.g. by threads of singer-aws-sync-all
+    fd, path_tmp = tempfile.mkstemp(dir=os.path.dirname(pruned_path), prefix=f"{digest}.", suffix=".tmp")
+    with os.fdopen(fd, 'w') as fh:
+        fh.write(pruned)
+    os.replace(path_tmp, pruned_path)
+    logging.info(
+        f"SUCCESS: {path} pruned to {len(json.loads(pruned)['streams'])} of {len(catalog.get('streams', []))} "
+        f"streams, {len(pruned)} of {len(content)} bytes."
+        )
+    return(pruned_path)
+
+
+# metadata keys set by users (as opposed to taps) when selecting streams and properties
+USER_METADATA_KEYS = ('selected', 'replication-method', 'replication-key')
+
+
+def merge_catalogs(existing, discovered):
+    """
+    Carry selections (USER_METADATA_KEYS) of an existing catalog over to a newly
+    discovered one, matching streams by tap_stream_id and metadata by breadcrumb.
+    Returns the merged catalog and a dict of changes: added/removed streams and
+    added/removed properties per stream.
+    """
+
+    existing_streams = {stream['tap_stream_id']: stream for stream in existing.get('streams', [])}
+    discovered_ids = set(stream['tap_stream_id'] for stream in discovered.get('streams', []))
+
+    changes = {
+        "added_streams": [],
+        "removed_streams": [stream_id for stream_id in existing_streams if stream_id not in discovered_ids],
+        "added_properties": {},
+        "removed_properties": {},
+    }
+
+    for stream in discovered.get('streams', []):
+        stream_id = stream['tap_stream_id']
+        existing_stream = existing_streams.get(stream_id)
+        if existing_stream is None:
+            changes['added_streams'].append(stream_id)
+            continue
+
+        existing_metadata = metadata_by_breadcrumb(existing_stream)
+        discovered_breadcrumbs = set()
+
+        for item in stream.get('metadata', []):
+            breadcrumb = tuple(item['breadcrumb'])
+            discovered_breadcrumbs.add(breadcrumb)
+            previous = existing_metadata.get(breadcrumb)
+            if previous is None:
+                if breadcrumb:
+                    changes['added_properties'].setdefault(stream_id, []).append(breadcrumb[-1])
+                continue
+            for key in USER_METADATA_KEYS:
+                if key in previous:
+                    item.setdefault('metadata', {})[key] = previous[key]
+
+        removed = [breadcrumb[-1] for breadcrumb in existing_metadata if breadcrumb and breadcrumb not in discovered_breadcrumbs]
+        if removed:
+            changes['removed_properties'][stream_id] = removed
+
+    return(discovered, changes)
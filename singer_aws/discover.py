@@ -1,30 +1,33 @@
 import argparse
+import asyncio
 from datetime import datetime
+import json
 import os
-from singer_aws.prep_config import fetch_tap_config
-from subprocess import PIPE, Popen
+from singer_aws import engine
+from singer_aws.catalog import load_catalog, merge_catalogs
+from singer_aws.prep_config import fetch_tap_config, prefetch_configs
+from singer_aws.project_config import load_project_config
 from singer_aws.sync import cleanup_tap
-import yaml
 
 def main():
 
     # 1. parse shell arguments
     parser = argparse.ArgumentParser(description='Arguments for Singer Tap execution.')
     parser.add_argument('-t', '--tap', help='Name of Singer Tap to run,', required=True)
+    parser.add_argument('--merge', action='store_true', help='If passed, selections of streams and properties \
+        in the existing catalog are kept in the newly discovered one, and added/removed streams and \
+        properties are reported.')
+    parser.add_argument('--timeout-seconds', type=int, help='Seconds after which the discovery is killed \
+        (defaults to `timeout_seconds` of the tap or project in singer_project_config.yml, no limit if not set).')
     args = parser.parse_args()
     tap = args.tap
 
     singer_home = os.getcwd()
 
     # read singer project configuration file
-    with open("singer_project_config.yml", 'r') as stream:
-        try:
-            project_config = yaml.safe_load(stream)
+    project_config = load_project_config()
 
-        except yaml.YAMLError as exc:
-            print(f"ERROR occurred when reading singer_project_config.yml file: {exc}")
-
-    def discover(tap, project_config):
+    def discover(tap, project_config, merge=False, timeout=None):
         """
         Invoke Singer Discover shell command. Currently intended to be done only locally.
         After generating catalogs with this script, try this utility:
@@ -43,28 +46,59 @@ def main():
             ]
 
         path_catalog = os.path.join(singer_home, f"taps/{tap}/catalog.json")
+        # discovery output is streamed to disk, the catalog is replaced only once it succeeds
+        path_discovered = f"{path_catalog}.discovered"
 
         cmd_to_print = cmd + [">"] + [path_catalog]
         print(f'RUNNING: {tap} Discovery shell command:\n{" ".join(cmd_to_print)}')
-        proc = Popen(cmd, stdout=PIPE)
-
-        out, err = proc.communicate()
-        with open(path_catalog, "w") as catalog_file:
-            catalog_file.write(out.decode())
+        if timeout is None:
+            timeout = project_config['taps'][tap].get('timeout_seconds') or project_config.get('timeout_seconds')
+        with open(path_discovered, "wb") as discovered_file:
+            try:
+                returncode = engine.run_command(cmd, discovered_file, timeout)
+            except asyncio.TimeoutError:
+                os.remove(path_discovered)
+                raise ValueError(f"ERROR: {tap} Singer Tap Discovery shell command didn't finish within {timeout}s.")
+
+        if returncode != 0:
+            os.remove(path_discovered)
+            raise ValueError(f"ERROR: {tap} Singer Tap Discovery shell command failed (see its output above).")
+
+        if merge and os.path.exists(path_catalog):
+            merged, changes = merge_catalogs(load_catalog(path_catalog), load_catalog(path_discovered))
+            report_changes(tap, changes)
+            with open(path_discovered, "w") as discovered_file:
+                json.dump(merged, discovered_file, indent=2)
+
+        os.replace(path_discovered, path_catalog)
+        print(f"SUCCESS: {tap} Singer Tap Discovery shell command succeeded.")
+
+    def report_changes(tap, changes):
+        """
+        Print streams and properties added or removed since the previous discovery.
+        """
 
-        if proc.returncode != 0:
-            raise ValueError(f"ERROR: {tap} Singer Tap Discovery shell command failed:\n{err.decode()}")
-        else:
-            print(f"SUCCESS: {tap} Singer Tap Discovery shell command succeeded.")
+        for stream_id in changes['added_streams']:
+            print(f"    + stream added: {stream_id}")
+        for stream_id in changes['removed_streams']:
+            print(f"    - stream removed: {stream_id}")
+        for stream_id, properties in changes['added_properties'].items():
+            print(f"    + properties added to {stream_id}: {properties}")
+        for stream_id, properties in changes['removed_properties'].items():
+            print(f"    - properties removed from {stream_id}: {properties}")
+        if not any(changes.values()):
+            print(f"    no streams or properties of {tap} added or removed since previous discovery.")
 
     # 2. get parameters for the tap from AWS Parameter Store
+    prefetch_configs([tap], [], project_config)
     clean_tap_config = fetch_tap_config(tap, project_config)
 
-    # 3. run Singer discover to generate catalog file
-    discover(tap, project_config)
-
-    # 4. cleanup temporary folders
-    cleanup_tap(tap, clean_tap_config)
+    try:
+        # 3. run Singer discover to generate catalog file
+        discover(tap, project_config, args.merge, args.timeout_seconds)
+    finally:
+        # 4. cleanup temporary folders
+        cleanup_tap(tap, clean_tap_config)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,569 @@
+import asyncio
+from collections import deque
+import io
+import logging
+import os
+from singer_aws import monitor
+from singer_aws.pipe import FAN_OUT_BUFFER_BYTES, SPILL_READ_BYTES, SpoolReader, spill_path
+import sys
+import tempfile
+import time
+
+"""
+Pipeline engine running Singer taps, stages (see singer_aws.pipe) and targets as coroutines
+of an asyncio event loop, instead of a thread per pipe:
+
+    tap(s) --> reader per tap --> queue --> relay (stages) --> feed per target --> target(s)
+                                                     target stdout --> on_line (e.g. states)
+                                                     target stderr --> stderr & tail
+
+Queues and buffers between coroutines are bounded, so a slow target slows the tap down
+instead of growing memory. Without stages (and with a single tap, a single unbuffered
+target), the tap is connected to the target by an OS pipe, and singer-aws only watches both.
+
+Once its timeout expires or a process exceeds its resource limits, the taps of a pipeline
+are stopped (SIGTERM), so that targets load what they have and emit their final state;
+processes which don't exit within KILL_GRACE_SECONDS after that are killed. Cancelling
+a pipeline kills its processes. Many pipelines can run on a single event loop (see run_many,
+e.g. windows of a backfill), at the cost of a few coroutines each.
+"""
+
+# bytes read from stdout of a tap at once
+READ_CHUNK_BYTES = 256 * 1024
+
+# chunks of messages queued between taps and the relay
+QUEUE_CHUNKS = 16
+
+# bytes of messages written into a target at once
+WRITE_BATCH_BYTES = 256 * 1024
+
+# seconds processes get to exit once their pipeline is stopped, before they're killed
+KILL_GRACE_SECONDS = 30
+
+# number of trailing stderr lines of a target kept to be reported on failure
+STDERR_TAIL_LINES = 100
+
+# longest line (e.g. a state) read from stdout or stderr of a target
+TARGET_LINE_LIMIT = 64 * 1024 * 1024
+
+
+class TargetFeed:
+    """
+    Writes messages into stdin of a target. Unbuffered (buffer_bytes None), put() waits
+    until the target accepts the messages. Buffered, messages are written from a buffer of
+    up to buffer_bytes by a coroutine of their own, so that the tap keeps going while the
+    target is busy (e.g. while target-redshift runs COPY); if spill_bytes is set, messages
+    which don't fit into the buffer are written into a temporary file in spill_path, up to
+    spill_bytes, and fed to the target from there once the buffer is drained. If the target
+    exits early, its messages are discarded, so that other targets are not held back.
+    """
+
+    def __init__(self, name, stdin, buffer_bytes=None, spill_bytes=None):
+        self.name = name
+        self.stdin = stdin
+        self.buffer_bytes = buffer_bytes
+        self.spill_bytes = spill_bytes
+        self.buffer = deque()
+        self.size = 0
+        # spilled messages are appended at spill_written, and read back from spill_read
+        self.spill = None
+        self.spill_written = 0
+        self.spill_read = 0
+        self.spilled = 0
+        self.blocked_seconds = 0.0
+        self.closed = False
+        self.failed = False
+        self.condition = asyncio.Condition()
+        self.task = None
+        if buffer_bytes is not None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def write(self, lines):
+        try:
+            self.stdin.writelines(lines)
+            await self.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            logging.error(f"ERROR: {self.name} stopped reading messages, discarding the rest of them.")
+            self.failed = True
+
+    async def put(self, lines, size):
+        if self.failed:
+            return
+        if self.task is None:
+            await self.write(lines)
+            return
+
+        async with self.condition:
+            blocked = None
+            while not self.failed:
+                spilling = self.spill_written > self.spill_read
+                if not spilling and (self.size == 0 or self.size + size <= self.buffer_bytes):
+                    self.buffer.append((lines, size))
+                    self.size += size
+                    break
+                if self.spill_bytes and (self.spill_written == self.spill_read
+                                         or self.spill_written - self.spill_read + size <= self.spill_bytes):
+                    # messages keep their order: once spilling, everything goes to the spill
+                    # file until the target has read all of it
+                    self.write_spill(lines, size)
+                    break
+                if blocked is None:
+                    blocked = time.monotonic()
+                await self.condition.wait()
+            if blocked is not None:
+                self.blocked_seconds += time.monotonic() - blocked
+            self.condition.notify_all()
+
+    def write_spill(self, lines, size):
+        if self.spill is None:
+            os.makedirs(spill_path, exist_ok=True)
+            self.spill = tempfile.TemporaryFile(dir=spill_path, prefix=f"{self.name}-")
+        os.pwrite(self.spill.fileno(), b"".join(lines), self.spill_written)
+        self.spill_written += size
+        self.spilled += size
+
+    async def next_chunk(self):
+        """
+        Next messages to write to the target: from the buffer first, as spilled messages are newer.
+        Returns (lines, size, from_spill), or None once closed and drained.
+        """
+
+        async with self.condition:
+            while not self.buffer and self.spill_written == self.spill_read and not self.closed:
+                await self.condition.wait()
+            if self.buffer:
+                lines, size = self.buffer.popleft()
+                return(lines, size, False)
+            if self.spill_written > self.spill_read:
+                length = min(SPILL_READ_BYTES, self.spill_written - self.spill_read)
+                return([os.pread(self.spill.fileno(), length, self.spill_read)], length, True)
+            return(None)
+
+    async def run(self):
+        while True:
+            chunk = await self.next_chunk()
+            if chunk is None:
+                break
+            lines, size, from_spill = chunk
+            await self.write(lines)
+            async with self.condition:
+                if self.failed:
+                    self.buffer.clear()
+                    self.size = 0
+                    self.spill_read = self.spill_written
+                    self.condition.notify_all()
+                    break
+                if from_spill:
+                    self.spill_read += size
+                    if self.spill_read == self.spill_written:
+                        # spill file is drained, start over from its beginning
+                        self.spill.truncate(0)
+                        self.spill_read = self.spill_written = 0
+                else:
+                    self.size -= size
+                self.condition.notify_all()
+
+    async def close(self):
+        if self.task is not None:
+            async with self.condition:
+                self.closed = True
+                self.condition.notify_all()
+            await self.task
+        if self.spill is not None:
+            self.spill.close()
+        try:
+            self.stdin.close()
+            await self.stdin.wait_closed()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        if self.spilled:
+            logging.info(f"{self.name}: {self.spilled} bytes of messages spilled to disk, "
+                         f"tap blocked for {self.blocked_seconds:.1f}s by a full buffer.")
+
+    def stats(self):
+        """
+        Bytes spilled to disk and seconds the tap was blocked by a full buffer.
+        """
+        return({"spilled_bytes": self.spilled, "blocked_seconds": round(self.blocked_seconds, 4)})
+
+
+def process_all(stage, lines):
+    for line in lines:
+        yield from stage.process(line)
+
+
+class Pipeline:
+    """
+    Runs taps (list of (name, command)) or, if replay_path is passed, messages of a spool
+    (see singer_aws.pipe.SpoolReader), through stages into targets (list of dicts with
+    name, cmd and on_line, called with every line the target writes to stdout).
+
+    Messages of several taps are merged (each tap keeps its order). With several targets or
+    with buffered set, every target is fed from its own buffer of buffer_bytes (spilling up
+    to spill_bytes, see TargetFeed). limits map process names to their resource limits (see
+    singer_aws.monitor); once a limit or the timeout (seconds) is exceeded, taps are stopped
+    and `stopped` holds the reason.
+
+    After run(): tap_returncode (first non-zero return code of the taps), returncodes and
+    stderr tails of targets by name, monitor (None unless available), and read_seconds /
+    write_seconds (time the relay waited for taps / targets) with feeds, if relayed.
+    """
+
+    def __init__(self, taps, targets, stages=(), replay_path=None, buffer_bytes=None, spill_bytes=None,
+                 buffered=False, timeout=None, limits=None, monitor_interval=None):
+        self.taps = taps
+        self.targets = targets
+        self.stages = list(stages)
+        self.replay_path = replay_path
+        self.buffer_bytes = buffer_bytes
+        self.spill_bytes = spill_bytes
+        self.buffered = buffered
+        self.timeout = timeout
+        self.limits = limits or {}
+        self.monitor_interval = monitor_interval or monitor.MONITOR_INTERVAL
+        self.procs_tap = []
+        self.procs_target = {}
+        self.feeds = []
+        self.relayed = False
+        self.read_seconds = 0.0
+        self.write_seconds = 0.0
+        self.stopped = None
+        self.monitor = None
+        self.monitored = monitor.available()
+        self.exit_fds = set()
+        self.tap_returncode = 0
+        self.returncodes = {}
+        self.stderr_tails = {}
+        self.background = []
+        for stage in self.stages:
+            stage.relay = self
+
+    def stop(self, reason):
+        """
+        Stop taps (once), so that targets load what they have and emit their final state.
+        """
+
+        if self.stopped is not None:
+            return
+        self.stopped = reason
+        logging.error(f"ERROR: {reason}, stopping the tap so that the target saves its final state.")
+        for proc in self.procs_tap:
+            if proc.returncode is None:
+                proc.terminate()
+        # e.g. a target which doesn't exit at the end of its input
+        self.background.append(asyncio.ensure_future(self.kill_after_grace()))
+
+    async def kill_after_grace(self):
+        await asyncio.sleep(KILL_GRACE_SECONDS)
+        logging.error(f"ERROR: processes didn't exit {KILL_GRACE_SECONDS}s after they were stopped, killing them.")
+        self.kill()
+
+    def kill(self):
+        for proc in self.procs_tap + list(self.procs_target.values()):
+            if proc.returncode is None:
+                proc.kill()
+
+    async def spawn(self, cmd, **kwargs):
+        """
+        Start a process. If resources are monitored, it inherits the write end of a pipe, closed
+        when it exits, so that it's sampled once more just before it's reaped (see on_exit).
+        """
+
+        if not self.monitored:
+            return(await asyncio.create_subprocess_exec(*cmd, **kwargs))
+        read_fd, write_fd = os.pipe()
+        try:
+            proc = await asyncio.create_subprocess_exec(*cmd, pass_fds=(write_fd,), **kwargs)
+        except BaseException:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        self.exit_fds.add(read_fd)
+        return(proc)
+
+    def on_exit(self, fd):
+        """
+        Sample processes once one of them exits, so that short runs don't end with usage of their last sample.
+        """
+
+        asyncio.get_running_loop().remove_reader(fd)
+        self.exit_fds.discard(fd)
+        os.close(fd)
+        self.monitor.sample()
+
+    async def start(self):
+        direct = (self.replay_path is None and not self.stages and not self.buffered
+                  and len(self.taps) == 1 and len(self.targets) == 1)
+        if direct:
+            read_fd, write_fd = os.pipe()
+            try:
+                self.procs_tap.append(await self.spawn(self.taps[0][1], stdout=write_fd))
+                target = self.targets[0]
+                self.procs_target[target["name"]] = await self.spawn(
+                    target["cmd"], stdin=read_fd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                    limit=TARGET_LINE_LIMIT)
+            finally:
+                # the tap gets SIGPIPE if the target exits early
+                os.close(read_fd)
+                os.close(write_fd)
+            return
+
+        self.relayed = True
+        for _, cmd in self.taps:
+            self.procs_tap.append(await self.spawn(
+                cmd, stdout=asyncio.subprocess.PIPE, limit=READ_CHUNK_BYTES))
+        for target in self.targets:
+            self.procs_target[target["name"]] = await self.spawn(
+                target["cmd"], stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE, limit=TARGET_LINE_LIMIT)
+        buffer_bytes = None
+        if len(self.targets) > 1 or self.buffered:
+            buffer_bytes = self.buffer_bytes or FAN_OUT_BUFFER_BYTES
+        self.feeds = [TargetFeed(target["name"], self.procs_target[target["name"]].stdin, buffer_bytes,
+                                 self.spill_bytes) for target in self.targets]
+
+    async def read_tap(self, stream, queue, split):
+        """
+        Queue stdout of a tap in chunks, split into lines if they are merged with other taps
+        or passed through stages.
+        """
+
+        pending = []
+        while True:
+            chunk = await stream.read(READ_CHUNK_BYTES)
+            if not chunk:
+                break
+            if not split:
+                await queue.put([chunk])
+                continue
+            end = chunk.rfind(b"\n") + 1
+            if end == 0:
+                # a message longer than a chunk
+                pending.append(chunk)
+                continue
+            data = b"".join(pending + [chunk[:end]]) if pending else chunk[:end]
+            pending = [chunk[end:]] if end < len(chunk) else []
+            await queue.put(io.BytesIO(data).readlines())
+        if pending:
+            await queue.put([b"".join(pending)])
+        await queue.put(None)
+
+    async def read_spool(self, queue):
+        reader = SpoolReader(self.replay_path)
+
+        def read_lines():
+            lines = []
+            size = 0
+            while size < READ_CHUNK_BYTES:
+                line = reader.readline()
+                if not line:
+                    break
+                lines.append(line)
+                size += len(line)
+            return(lines)
+
+        try:
+            while True:
+                lines = await asyncio.to_thread(read_lines)
+                if not lines:
+                    break
+                await queue.put(lines)
+        finally:
+            reader.close()
+            await queue.put(None)
+
+    def feed_stats(self):
+        """
+        Bytes spilled to disk and seconds the relay was blocked by a full buffer, per target
+        (None unless targets are buffered).
+        """
+
+        if not self.feeds or self.feeds[0].task is None:
+            return(None)
+        return({feed.name: feed.stats() for feed in self.feeds})
+
+    def pass_through(self, lines, stages):
+        for stage in stages:
+            lines = process_all(stage, lines)
+        return(lines)
+
+    async def write(self, lines):
+        """
+        Write messages (any iterable) into all targets in batches, so that messages held
+        by stages (see singer_aws.pipe.CompactStage) are never all in memory at once.
+        """
+
+        batch = []
+        size = 0
+        for line in lines:
+            batch.append(line)
+            size += len(line)
+            if size >= WRITE_BATCH_BYTES:
+                await self.put(batch, size)
+                batch = []
+                size = 0
+        if batch:
+            await self.put(batch, size)
+
+    async def put(self, lines, size):
+        start = time.monotonic()
+        for feed in self.feeds:
+            await feed.put(lines, size)
+        self.write_seconds += time.monotonic() - start
+        if all(feed.failed for feed in self.feeds):
+            # no target reads anymore, the taps would block forever
+            for proc in self.procs_tap:
+                if proc.returncode is None:
+                    proc.terminate()
+
+    async def relay(self):
+        queue = asyncio.Queue(maxsize=QUEUE_CHUNKS)
+        if self.replay_path is not None:
+            readers = [asyncio.ensure_future(self.read_spool(queue))]
+        else:
+            split = len(self.procs_tap) > 1 or bool(self.stages)
+            readers = [asyncio.ensure_future(self.read_tap(proc.stdout, queue, split)) for proc in self.procs_tap]
+
+        try:
+            remaining = len(readers)
+            while remaining:
+                start = time.monotonic()
+                lines = await queue.get()
+                self.read_seconds += time.monotonic() - start
+                if lines is None:
+                    remaining -= 1
+                    continue
+                if self.stages:
+                    await self.write(self.pass_through(lines, self.stages))
+                elif not all(feed.failed for feed in self.feeds):
+                    await self.put(lines, sum(len(line) for line in lines))
+
+            # flush messages held by stages, passing them through all subsequent stages
+            for i, stage in enumerate(self.stages):
+                await self.write(self.pass_through(stage.close(), self.stages[i+1:]))
+        finally:
+            for reader in readers:
+                reader.cancel()
+            for feed in self.feeds:
+                await feed.close()
+
+    async def read_target(self, target, proc):
+        """
+        Pass every line of stdout of a target to its on_line callback.
+        """
+
+        on_line = target.get("on_line")
+        while True:
+            line = await proc.stdout.readline()
+            if not line:
+                break
+            if on_line is not None:
+                on_line(line)
+
+    async def drain_stderr(self, name, stream, echo=None):
+        """
+        Forward stderr of a target to our stderr, keeping its last lines.
+        """
+
+        echo = echo or sys.stderr.buffer
+        tail = self.stderr_tails[name] = deque(maxlen=STDERR_TAIL_LINES)
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            tail.append(line)
+            echo.write(line)
+            echo.flush()
+
+    async def watch(self):
+        """
+        Stop the pipeline once its timeout expires.
+        """
+
+        await asyncio.sleep(self.timeout)
+        self.stop(f"timeout of {self.timeout}s exceeded")
+
+    async def run(self):
+        tasks = []
+        try:
+            await self.start()
+            if self.relayed:
+                tasks.append(asyncio.ensure_future(self.relay()))
+            for target in self.targets:
+                proc = self.procs_target[target["name"]]
+                tasks.append(asyncio.ensure_future(self.read_target(target, proc)))
+                tasks.append(asyncio.ensure_future(self.drain_stderr(target["name"], proc.stderr)))
+
+            if self.monitored:
+                names = [name for name, _ in self.taps] + [target["name"] for target in self.targets]
+                processes = dict(zip(names, self.procs_tap + [self.procs_target[target["name"]] for target in self.targets]))
+                self.monitor = monitor.ResourceMonitor(processes, self.limits, self.monitor_interval,
+                                                       on_limit=lambda name, reason: self.stop(reason))
+                self.background.append(asyncio.ensure_future(self.monitor.run()))
+                for fd in self.exit_fds:
+                    asyncio.get_running_loop().add_reader(fd, self.on_exit, fd)
+            if self.timeout:
+                self.background.append(asyncio.ensure_future(self.watch()))
+
+            await asyncio.gather(*tasks)
+            for name, proc in self.procs_target.items():
+                self.returncodes[name] = await proc.wait()
+            tap_returncodes = [await proc.wait() for proc in self.procs_tap]
+            self.tap_returncode = next((returncode for returncode in tap_returncodes if returncode != 0), 0)
+        except BaseException:
+            # cancelled, or failed: don't leave processes behind
+            for task in tasks:
+                task.cancel()
+            self.kill()
+            for proc in self.procs_tap + list(self.procs_target.values()):
+                await proc.wait()
+            raise
+        finally:
+            for task in self.background:
+                task.cancel()
+            # e.g. a process left running by a tap which exited
+            for fd in self.exit_fds:
+                asyncio.get_running_loop().remove_reader(fd)
+                os.close(fd)
+            self.exit_fds.clear()
+
+
+def run_many(runs, concurrency=None):
+    """
+    Run several pipelines (or coroutines running them, e.g. singer_aws.sync.run_sync) on a single
+    event loop, up to concurrency at a time. Returns their results, or exceptions they raised.
+    """
+
+    async def run_one(run, semaphore):
+        async with semaphore:
+            try:
+                return(await (run.run() if isinstance(run, Pipeline) else run))
+            except SystemExit as exc:
+                # raised e.g. when S3 is not reachable, mustn't stop other pipelines
+                return(exc)
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(concurrency or len(runs) or 1)
+        return(await asyncio.gather(*(run_one(run, semaphore) for run in runs), return_exceptions=True))
+
+    return(asyncio.run(run_all()))
+
+
+def run_command(cmd, stdout, timeout=None):
+    """
+    Run a command (e.g. discovery of a tap) with stdout written to a file, killing it
+    if it doesn't finish within timeout seconds. Returns its return code.
+    """
+
+    async def run_and_wait():
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=stdout)
+        try:
+            return(await asyncio.wait_for(proc.wait(), timeout))
+        except BaseException:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+
+    return(asyncio.run(run_and_wait()))
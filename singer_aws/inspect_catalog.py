@@ -1,6 +1,123 @@
 import json
 import argparse
 import logging
+import os
+from singer_aws.catalog import catalog_index, compile_catalog, load_catalog, pruned_catalog_path
+from singer_aws.prep_config import fetch_tap_config
+from singer_aws.project_config import load_project_config
+from subprocess import DEVNULL, PIPE, Popen
+import sys
+
+# properties of streams compared by check_pruned
+COMPARED_PROPERTIES = ['selected', 'selected_properties', 'key_properties', 'replication_method', 'replication_key']
+
+
+def check_pruned(catalog_path):
+    """
+    Compare selection of streams and properties of a catalog and of its pruned version
+    (see singer_aws.catalog.prune_catalog). Returns path of the pruned catalog and list of differences.
+    """
+
+    full = catalog_index(catalog_path)
+    pruned_path = pruned_catalog_path(catalog_path)
+    pruned = compile_catalog(load_catalog(pruned_path))
+
+    differences = []
+    for stream_id, stream in full['streams'].items():
+        pruned_stream = pruned['streams'].get(stream_id)
+        if pruned_stream is None:
+            if stream['selected']:
+                differences.append(f"{stream_id}: selected stream is missing in the pruned catalog")
+            continue
+        for key in COMPARED_PROPERTIES:
+            if stream[key] != pruned_stream[key]:
+                differences.append(f"{stream_id}: {key} is {stream[key]!r}, {pruned_stream[key]!r} in the pruned catalog")
+
+    return(pruned_path, differences)
+
+
+def tap_messages(cmd, max_lines):
+    """
+    Run a tap, collecting its SCHEMA and RECORD messages by stream (up to max_lines messages).
+    Returns the messages and whether the tap finished within max_lines.
+    """
+
+    proc = Popen(cmd, stdout=PIPE, stderr=DEVNULL)
+    messages = {}
+    complete = True
+    for i, line in enumerate(proc.stdout):
+        if i == max_lines:
+            complete = False
+            break
+        try:
+            message = json.loads(line)
+        except ValueError:
+            continue
+        if message.get('type') in ['SCHEMA', 'RECORD']:
+            # differs between any two runs
+            message.pop('time_extracted', None)
+            messages.setdefault(message['stream'], []).append(message)
+    if not complete:
+        proc.terminate()
+    proc.stdout.close()
+    if proc.wait() != 0 and complete:
+        raise ValueError(f"ERROR: {' '.join(cmd)} failed with code {proc.returncode}.")
+    return(messages, complete)
+
+
+def restrict_schema(message, properties):
+    schema = dict(message['schema'])
+    schema['properties'] = {name: value for name, value in schema.get('properties', {}).items() if name in properties}
+    if 'required' in schema:
+        schema['required'] = [name for name in schema['required'] if name in properties]
+    return(dict(message, schema=schema))
+
+
+def compare_tap_output(tap, project_config, catalog_path, pruned_path, max_lines, state_path=None):
+    """
+    Run a tap with its full and with its pruned catalog, and compare their RECORD and SCHEMA
+    messages stream by stream (SCHEMA messages only by properties of the pruned catalog, as
+    unselected properties are meant to be dropped from them). Returns list of differences.
+    """
+
+    tap_properties = project_config['taps'].get(f"tap-{tap}") or {}
+    tap_module = tap_properties.get('module') or f"tap-{tap}"
+    catalog_arg = tap_properties.get('catalog_arg') or '--catalog'
+
+    clean_tap_config = fetch_tap_config(tap, project_config)
+    try:
+        outputs = []
+        for path in [catalog_path, pruned_path]:
+            cmd = [f"venv/tap-{tap}/bin/{tap_module}", "--config", f"taps/tap-{tap}/config.json", catalog_arg, path]
+            if state_path is not None:
+                cmd += ["--state", state_path]
+            logging.info(f"RUNNING: {' '.join(cmd)}")
+            outputs.append(tap_messages(cmd, max_lines))
+    finally:
+        if clean_tap_config:
+            os.remove(f"taps/tap-{tap}/config.json")
+
+    (full, full_complete), (pruned, pruned_complete) = outputs
+    pruned_properties = {
+        stream['stream']: set(stream['properties']) for stream in compile_catalog(load_catalog(pruned_path))['streams'].values()
+        }
+
+    differences = []
+    for stream in sorted(set(full) | set(pruned)):
+        full_messages = full.get(stream, [])
+        pruned_messages = pruned.get(stream, [])
+        if full_complete and pruned_complete and len(full_messages) != len(pruned_messages):
+            differences.append(f"{stream}: {len(full_messages)} messages, {len(pruned_messages)} with the pruned catalog")
+        for i, (message, pruned_message) in enumerate(zip(full_messages, pruned_messages)):
+            if message.get('type') == 'SCHEMA' == pruned_message.get('type') and stream in pruned_properties:
+                message = restrict_schema(message, pruned_properties[stream])
+                pruned_message = restrict_schema(pruned_message, pruned_properties[stream])
+            if message != pruned_message:
+                differences.append(f"{stream}: message {i} ({message.get('type')}) differs with the pruned catalog")
+                break
+
+    return(differences)
+
 
 def main():
 
@@ -8,50 +125,92 @@ def main():
 
     parser = argparse.ArgumentParser(description='Arguments for Singer Tap execution.')
     parser.add_argument('--tap', help='Name of Singer Tap to inspect,', required=True)
+    parser.add_argument('--stream', action='append', help='Inspect only given stream (tap_stream_id), \
+        can be passed multiple times.')
+    parser.add_argument('--selected-only', action='store_true', help='Inspect only selected streams.')
+    parser.add_argument('--json', action='store_true', help='Print result as JSON, for use by other tools.')
+    parser.add_argument('--check-pruned', action='store_true', help='Check that the pruned catalog handed to \
+        the tap by singer-aws-sync --prune-catalog selects the same streams and properties.')
+    parser.add_argument('--run-tap', action='store_true', help='If passed with --check-pruned, the tap is also \
+        run with both catalogs and their output is compared.')
+    parser.add_argument('--max-lines', type=int, default=10000, help='Messages of the tap compared by --run-tap \
+        (10000 by default).')
+    parser.add_argument('--state', help='State file passed to the tap by --run-tap.')
     args = parser.parse_args()
     tap = args.tap
     tap_config_path = f"taps/tap-{tap}/catalog.json"
 
     try:
-        with open(tap_config_path) as tap_catalog:
-            tap_catalog_json = json.load(tap_catalog)
-    except:
+        index = catalog_index(tap_config_path)
+    except OSError:
         logging.error(f"ERROR: {tap_config_path} catalog path does not exist.")
+        sys.exit(1)
+
+    if args.check_pruned:
+        pruned_path, differences = check_pruned(tap_config_path)
+        if args.run_tap and not differences:
+            differences = compare_tap_output(tap, load_project_config(), tap_config_path, pruned_path,
+                                             args.max_lines, args.state)
+        if args.json:
+            print(json.dumps({"pruned_catalog": pruned_path, "differences": differences}, indent=2))
+        for difference in differences:
+            logging.error(f"ERROR: {difference}")
+        if differences:
+            sys.exit(1)
+        logging.info(f"SUCCESS: pruned catalog of tap-{tap} ({pruned_path}) is equivalent to {tap_config_path}.")
+        return
 
-    tap_catalog_json['streams']
-    streams = tap_catalog_json['streams']
+    if args.stream:
+        unknown = [stream_id for stream_id in args.stream if stream_id not in index['streams']]
+        if unknown:
+            logging.error(f"ERROR: streams not found in {tap_config_path}: {', '.join(unknown)}")
+            sys.exit(1)
+        stream_ids = args.stream
+    else:
+        stream_ids = list(index['streams'].keys())
+
+    streams = []
+    for stream_id in stream_ids:
+        stream = index['streams'][stream_id]
+        if args.selected_only and not stream['selected']:
+            continue
+        streams.append({
+            "tap_stream_id": stream_id,
+            "selected": stream['selected'],
+            "properties": stream['properties'],
+            "marked_properties": stream['marked_properties_list'],
+            "replicated_properties": stream['selected_properties_list'],
+            "key_properties": stream['key_properties'],
+            "replication_method": stream['replication_method'],
+            "replication_key": stream['replication_key'],
+            "valid_replication_keys": stream['valid_replication_keys'],
+        })
+
+    if args.json:
+        print(json.dumps(streams, indent=2))
+        return
 
     for stream in streams:
 
-        stream_id = stream['tap_stream_id']
-        print(f"inspecting stream: {stream_id}...")
-
-        for meta_item in stream['metadata']:
-            if len(meta_item['breadcrumb']) == 0 and meta_item['metadata']['selected']:
-                print(f"    \u2705 stream is SELECTED")
-                continue
-            elif len(meta_item['breadcrumb']) == 0 and not meta_item['metadata']['selected']:
-                print(f"    \u274C stream is NOT SELECTED")
-                continue
-            else:
-                continue
-
-        count_properties = len(stream['schema']['properties'].keys())
-        print(f"    \u2022 found {count_properties} available properties")
-
-        selected_properties_list = []
-        count_selected_properties = 0
-
-        for meta_item in stream['metadata']:
-            if len(meta_item['breadcrumb']) > 0:
-                if meta_item['metadata'].get('selected'):
-                    count_selected_properties += 1
-                    selected_properties_list.append(meta_item['breadcrumb'][1])
-            else:
-                continue
-
-        print(f"    \u2022 found {count_selected_properties} selected properties")
-        print(f"    \u2022 selected properties: {selected_properties_list}")
+        print(f"inspecting stream: {stream['tap_stream_id']}...")
+
+        if stream['selected']:
+            print(f"    ✅ stream is SELECTED")
+        else:
+            print(f"    ❌ stream is NOT SELECTED")
+
+        count_properties = len(stream['properties'])
+        print(f"    • found {count_properties} available properties")
+
+        selected_properties_list = stream['marked_properties']
+        count_selected_properties = len(selected_properties_list)
+
+        print(f"    • found {count_selected_properties} selected properties")
+        print(f"    • selected properties: {selected_properties_list}")
+
+        if stream['replication_key'] or stream['valid_replication_keys']:
+            replication_key = stream['replication_key'] or stream['valid_replication_keys']
+            print(f"    • replication key: {replication_key}")
 
 if __name__ == '__main__':
     main()
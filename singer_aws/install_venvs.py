@@ -1,16 +1,71 @@
 #!/usr/bin/env python
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import os
+from singer_aws.cache import cache_dir
+from singer_aws.project_config import load_project_config
 import subprocess
-import yaml
+import sys
+import threading
+
+# file inside of a venv holding hash of everything the venv has been installed from
+STAMP_FILENAME = ".singer-aws-requirements.sha256"
 
 def main():
 
+    parser = argparse.ArgumentParser(description='Install virtual environments of Singer Taps and Targets.')
+    parser.add_argument('--only', action='append', help='Name of a tap/target (e.g. tap-adwords) to install, \
+        can be passed multiple times. All taps and targets are installed if not passed.')
+    parser.add_argument('--jobs', type=int, default=min(4, os.cpu_count() or 1), help='Number of virtual \
+        environments installed in parallel.')
+    parser.add_argument('--force', action='store_true', help='If passed, virtual environments are rebuilt \
+        even if their requirements have not changed.')
+    args = parser.parse_args()
+
+    print_lock = threading.Lock()
+
+    # all venvs share pip's http & wheel cache, instead of downloading & building
+    # every package once per venv (and on every install)
+    pip_cache = cache_dir('pip')
+
+    python_version = subprocess.run(
+        ["python3", "-c", "import sys; print(sys.version)"], stdout=subprocess.PIPE, check=True
+        ).stdout.decode().strip()
+
+    def requirements_hash(type, name, env_vars):
+        """
+        Hash of requirements.txt, python version and env vars a venv is installed with.
+        """
+
+        with open(f"{type}s/{name}/requirements.txt", 'rb') as fh:
+            requirements = fh.read()
+
+        digest = hashlib.sha256(requirements)
+        digest.update(python_version.encode())
+        digest.update(json.dumps(env_vars, sort_keys=True).encode())
+        return(digest.hexdigest())
+
     def install_venv(type, alias, module, env_vars):
 
         name = alias or module
         env_vars = env_vars or {}
 
-        print(f"Installing virtual environment for {name}...")
+        stamp_path = f"venv/{name}/{STAMP_FILENAME}"
+        new_hash = requirements_hash(type, name, env_vars)
+
+        if not args.force and os.path.exists(f"venv/{name}/bin/python"):
+            try:
+                with open(stamp_path) as fh:
+                    if fh.read().strip() == new_hash:
+                        with print_lock:
+                            print(f"Virtual environment for {name} is up to date, skipping.")
+                        return(True)
+            except OSError:
+                pass
+
+        output = [f"Installing virtual environment for {name}..."]
 
         pip = os.path.join(f"venv/{name}/bin", "pip")
 
@@ -18,32 +73,61 @@ def main():
             ["rm", "-rf", f"venv/{name}"],
             ["python3", "-m", "venv", f"venv/{name}"],
             [pip, "install", "-U", "pip"],
-            [pip, "install", "--no-cache-dir", "-r", f"{type}s/{name}/requirements.txt"]
+            [pip, "install", "-r", f"{type}s/{name}/requirements.txt"]
         ]
 
         my_env = os.environ.copy()
+        my_env['PIP_CACHE_DIR'] = pip_cache
         for key, value in env_vars.items():
             my_env[key] = value
 
+        succeeded = True
         for cmd in commands:
-            print(" ".join(cmd))
+            output.append(" ".join(cmd))
             process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env = my_env)
             out, err = process.communicate()
-            print(out.decode(), err.decode())
+            output.append(out.decode() + err.decode())
+            if process.returncode != 0:
+                output.append(f"ERROR: installation of virtual environment for {name} failed.")
+                succeeded = False
+                break
+
+        if succeeded:
+            with open(stamp_path, 'w') as fh:
+                fh.write(new_hash)
+
+        # venvs are installed in parallel, so print output of each one in a single block
+        with print_lock:
+            print("\n".join(output))
+
+        return(succeeded)
+
+
+    project_config = load_project_config()
 
+    venvs = []
+    for tap, config in project_config['taps'].items():
+        venvs.append(('tap', tap, config.get('module'), config.get('env_vars')))
 
-    with open("singer_project_config.yml", 'r') as stream:
-        try:
-            project_config = yaml.safe_load(stream)
+    for target, config in project_config['targets'].items():
+        venvs.append(('target', target, config.get('module'), config.get('env_vars')))
 
-            for tap, config in project_config['taps'].items():
-                install_venv('tap', tap, config.get('module'), config.get('env_vars'))
+    if args.only:
+        unknown = set(args.only) - set(alias for _, alias, _, _ in venvs)
+        if unknown:
+            print(f"ERROR: {', '.join(sorted(unknown))} not found in singer_project_config.yml.")
+            sys.exit(1)
+        # installing a single integration always rebuilds it
+        args.force = True
+        venvs = [venv for venv in venvs if venv[1] in args.only]
 
-            for target, config in project_config['targets'].items():
-                install_venv('target', target, config.get('module'), config.get('env_vars'))
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(lambda venv: install_venv(*venv), venvs))
 
-        except yaml.YAMLError as exc:
-            print(exc)
+    failed = [venv[1] for venv, succeeded in zip(venvs, results) if not succeeded]
+    if failed:
+        print(f"ERROR: installation failed for: {', '.join(failed)}")
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -1,53 +1,225 @@
 import argparse
 from datetime import datetime
+import json
+import logging
 import os
-from singer_aws.prep_config import fetch_tap_config, fetch_target_config
-from singer_aws.sync import sync, send_state, cleanup_tap, cleanup_target
-from subprocess import PIPE, run
-import yaml
+from singer_aws import report
+from singer_aws.prep_config import fetch_tap_config, fetch_target_config, prefetch_configs
+from singer_aws.project_config import load_project_config
+from singer_aws.pipe import build_stages
+from singer_aws.report import phase, report_prefix
+from singer_aws.sync import sync, send_state, s3_client, cleanup_tap, cleanup_target
 
-def main():
+def add_sync_arguments(parser):
+    """
+    Add arguments shared by all commands running taps into targets.
+    """
 
-    # 1. parse shell arguments
-    parser = argparse.ArgumentParser(description='Arguments for Singer Tap execution.')
-    parser.add_argument('--tap', help='Name of Singer Tap to run,', required=True)
-    parser.add_argument('--target', help='Name of Singer Tap target to run into.', required=True)
     parser.add_argument('--ignore-state',  action='store_true', help='If passed, this flag makes \
         singer tap execution ignore the state file, starting replication from the start_date (== epoch) \
         as defined in config file.')
-    args = parser.parse_args()
+    parser.add_argument('--checkpoint-seconds', type=int, help='If passed, newest state emitted by \
+        the target is uploaded to S3 every N seconds during the sync, so that a failed run resumes \
+        from its last checkpoint.')
+    parser.add_argument('--checkpoint-states', type=int, help='If passed, newest state emitted by \
+        the target is uploaded to S3 every N state messages during the sync.')
+    parser.add_argument('--meter', action='store_true', default=None, help='If passed, messages of the tap \
+        are counted per stream on their way to the target; progress is logged periodically and a summary \
+        is written to metrics/tap-name-metrics.json.')
+    parser.add_argument('--meter-interval', type=int, help='Seconds between progress lines logged by --meter \
+        (60 by default).')
+    parser.add_argument('--drop-unselected', action='store_true', default=None, help='If passed, properties \
+        not selected in the catalog of the tap are dropped from its messages before they reach the target.')
+    parser.add_argument('--spool', action='store_true', default=None, help='If passed, messages of the tap \
+        are also saved in compressed chunks in spool/tap-name/, to be replayed with singer-aws-replay if the \
+        target fails. Spool is deleted after a successful sync.')
+    parser.add_argument('--spool-upload', action='store_true', default=None, help='If passed with --spool, \
+        spool is also uploaded to S3 data_bucket.')
+    parser.add_argument('--spool-keep', action='store_true', default=None, help='If passed with --spool, \
+        spool is kept even after a successful sync.')
+    parser.add_argument('--timeout-seconds', type=int, help='If passed, the tap is stopped after N seconds, \
+        state loaded by then is saved and the sync fails.')
+    parser.add_argument('--prune-catalog', action='store_true', default=None, help='If passed, the tap is handed \
+        a catalog with only selected streams and properties instead of taps/tap-name/catalog.json, so that \
+        it starts faster (check it with singer-aws-inspect --check-pruned first).')
+    parser.add_argument('--dedup-schemas', action='store_true', default=None, help='If passed, SCHEMA messages \
+        identical to the previous SCHEMA message of their stream are not sent to the target.')
+    parser.add_argument('--compact', action='store_true', default=None, help='If passed, records of streams \
+        with key_properties are held until the next state message, and only the latest version of every key \
+        is sent to the target.')
+    parser.add_argument('--compact-memory-bytes', type=int, help='Size of records held in memory by --compact \
+        (64MB by default).')
+    parser.add_argument('--compact-spill-bytes', type=int, help='If passed with --compact, records which don\'t \
+        fit into memory are spilled to a temporary file in spill/, up to N bytes, instead of being sent early.')
+    parser.add_argument('--buffer-bytes', type=int, help='If passed, messages of the tap are buffered in memory \
+        for the target, up to N bytes, so that the tap keeps extracting while the target is busy loading.')
+    parser.add_argument('--spill-bytes', type=int, help='If passed, messages which don\'t fit into the buffer are \
+        spilled to a temporary file in spill/, up to N bytes, before the tap has to wait for the target.')
 
-    # read singer project configuration file
-    with open("singer_project_config.yml", 'r') as stream:
-        try:
-            project_config = yaml.safe_load(stream)
 
-        except yaml.YAMLError as exc:
-            print(f"ERROR occurred when reading singer_project_config.yml file: {exc}")
+def run_pipeline(tap, target, project_config, args, target_config_path=None, replay_path=None, extra_targets=()):
+    """
+    Fetch configs, run "tap | target" and clean up after it, for a single tap and target.
+    If replay_path (a spool directory) is passed, it's fed into the target instead of the tap.
+    If extra_targets are passed, the tap fans out to all of them too.
+    If args.backfill_windows is passed, the tap is run as a backfill split into time windows
+    (see singer_aws.backfill). If args.stream_partitions is passed, selected streams of the tap
+    are replicated by several tap processes (see singer_aws.partition).
+    """
 
-    tap = args.tap
-    target = args.target
     aws_profile = project_config.get('redshift_aws_profile')
     ignore_state = args.ignore_state
+    backfill_windows = getattr(args, 'backfill_windows', None)
+    stream_partitions = getattr(args, 'stream_partitions', None)
+
+    if backfill_windows is not None:
+        if not ignore_state:
+            raise ValueError("ERROR: --backfill-windows can only be used with --ignore-state.")
+        if extra_targets or replay_path is not None:
+            raise ValueError("ERROR: --backfill-windows can't be used with several targets or replay.")
+
+    if stream_partitions is not None:
+        if backfill_windows is not None or extra_targets or replay_path is not None:
+            raise ValueError("ERROR: --stream-partitions can't be used with backfill, several targets or replay.")
 
     # 2. get tap config from env variable or AWS Parameter Store
-    clean_tap_config = fetch_tap_config(tap, project_config)
+    if replay_path is None:
+        with phase("fetch_tap_config"):
+            clean_tap_config = fetch_tap_config(tap, project_config)
+    else:
+        clean_tap_config = False
 
     # 3. get target parameters from AWS Parameter Store, enrich with arg input
     # current day, month, year to construct S3 prefix
     d = str('{:02d}'.format(datetime.now().day))
     m = str('{:02d}'.format(datetime.now().month))
     y = str('{:04d}'.format(datetime.now().year))
-    s3_key_prefix = f"singer/{args.tap}/{y}/{m}/{d}/"
-    clean_target_config = fetch_target_config(target, project_config, tap, s3_key_prefix)
+    s3_key_prefix = f"singer/{tap}/{y}/{m}/{d}/"
+    with phase("fetch_target_config"):
+        clean_target_config = fetch_target_config(target, project_config, tap, s3_key_prefix, target_config_path)
+        clean_extra_target_configs = [
+            fetch_target_config(extra_target, project_config, tap, s3_key_prefix) for extra_target in extra_targets
+            ]
 
     # 4. sync Singer Tap (runs the "venv/tap | venv/target" command)
     bucket = project_config.get('data_bucket')
-    sync(tap, target, project_config, bucket, ignore_state, aws_profile)
+    checkpoint_seconds = args.checkpoint_seconds or project_config.get('checkpoint_seconds')
+    checkpoint_states = args.checkpoint_states or project_config.get('checkpoint_states')
+    tap_options = project_config['taps'].get(f"tap-{tap}") or {}
+    buffering = {}
+    for name in ['buffer_bytes', 'spill_bytes']:
+        # argument, then property of the tap, then property of the project
+        buffering[name] = getattr(args, name, None) or tap_options.get(name, project_config.get(name))
+    buffer_bytes = (buffering['buffer_bytes'] or getattr(args, 'fan_out_buffer_bytes', None)
+                    or project_config.get('fan_out_buffer_bytes'))
+    try:
+        if backfill_windows is not None:
+            # imported here, as only backfills need it
+            from singer_aws.backfill import backfill
+
+            concurrency = args.backfill_concurrency or project_config.get('backfill_concurrency') or backfill_windows
+            backfill(tap, target, project_config, bucket, args, backfill_windows, concurrency, aws_profile,
+                     target_config_path)
+            return
+        if stream_partitions is not None:
+            # imported here, as only partitioned syncs need it
+            from singer_aws.partition import partitioned_sync
+
+            partitioned_sync(tap, target, project_config, bucket, args, stream_partitions, args.partition_targets,
+                             ignore_state, aws_profile, checkpoint_seconds, checkpoint_states, target_config_path)
+            return
+        stages = build_stages(f"tap-{tap}", project_config, args)
+        sync(tap, target, project_config, bucket, ignore_state, aws_profile, checkpoint_seconds, checkpoint_states,
+             target_config_path, stages, replay_path, extra_targets, buffer_bytes,
+             spill_bytes=buffering['spill_bytes'], buffered=bool(buffering['buffer_bytes'] or buffering['spill_bytes']),
+             prune_catalog=getattr(args, 'prune_catalog', None), timeout=getattr(args, 'timeout_seconds', None))
+    finally:
+        # 5. cleanup temporary folders
+        cleanup_tap(tap, clean_tap_config)
+        cleanup_target(target, clean_target_config, target_config_path)
+        for extra_target, clean_extra_target_config in zip(extra_targets, clean_extra_target_configs):
+            cleanup_target(extra_target, clean_extra_target_config)
+
+
+def finish_report(run_report, error, project_config, args):
+    """
+    Write the run report (see singer_aws.report) if it's enabled, and upload it to S3 if requested.
+    """
+
+    upload = args.report_upload or project_config.get('run_report_upload')
+    if not (args.report or args.profile or upload or project_config.get('run_report')):
+        return
+
+    result = run_report.finish(error)
+    run_report.write(result)
+
+    if upload:
+        key = f"{report_prefix(run_report.tap)}{run_report.name()}.json"
+        bucket = project_config.get('data_bucket')
+        try:
+            s3 = s3_client(project_config, project_config.get('redshift_aws_profile'))
+            s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(result).encode())
+            logging.info(f"SUCCESS: run report of {run_report.tap} uploaded to s3://{bucket}/{key}.")
+        except Exception:
+            # a report must never fail the run it describes
+            logging.warning(f"run report of {run_report.tap} wasn't uploaded to S3.")
+
+
+def build_parser():
+    """
+    Parser of singer-aws-sync arguments (also used for jobs of singer-aws-worker).
+    """
+
+    parser = argparse.ArgumentParser(description='Arguments for Singer Tap execution.')
+    parser.add_argument('--tap', help='Name of Singer Tap to run,', required=True)
+    parser.add_argument('--target', action='append', help='Name of Singer Tap target to run into. Can be \
+        passed multiple times to load the same tap into several targets at once.', required=True)
+    parser.add_argument('--fan-out-buffer-bytes', type=int, help='Size of messages buffered for each target \
+        when several targets are passed (16MB by default, same as --buffer-bytes).')
+    parser.add_argument('--backfill-windows', type=int, help='If passed with --ignore-state, the range between \
+        start_date of the tap config and now is split into N time windows replicated in parallel, and a single \
+        merged state is uploaded to S3 once all of them succeed.')
+    parser.add_argument('--backfill-concurrency', type=int, help='Max number of backfill windows running at \
+        the same time (all of them by default).')
+    parser.add_argument('--stream-partitions', type=int, help='If passed, selected streams of the tap are split \
+        into N partitions replicated by N tap processes at the same time, and their bookmarks are merged into \
+        a single state.')
+    parser.add_argument('--partition-targets', action='store_true', help='If passed with --stream-partitions, \
+        every tap process loads into its own target process, instead of all of them into a single one.')
+    parser.add_argument('--report', action='store_true', help='If passed, time spent in every phase of the run \
+        is written to reports/tap-name-<time>.json.')
+    parser.add_argument('--report-upload', action='store_true', help='If passed, the run report is also uploaded \
+        to S3 data_bucket, next to states of the tap.')
+    parser.add_argument('--profile', action='store_true', help='If passed, Python code of the run is profiled \
+        with cProfile, and its slowest functions are added to the run report.')
+    add_sync_arguments(parser)
+    return(parser)
+
+
+def main():
+
+    # 1. parse shell arguments
+    args = build_parser().parse_args()
+
+    run_report = report.start(f"tap-{args.tap}", args.target, args.profile)
+    project_config = {}
+    error = None
+    try:
+        # read singer project configuration file
+        with phase("load_project_config"):
+            project_config = load_project_config()
+
+        # fetch configs of tap and target from SSM in a single request
+        with phase("prefetch_configs"):
+            prefetch_configs([args.tap], args.target, project_config)
 
-    # 5. cleanup temporary folders
-    cleanup_tap(tap, clean_tap_config)
-    cleanup_target(target, clean_target_config)
+        run_pipeline(args.tap, args.target[0], project_config, args, extra_targets=args.target[1:])
+    except BaseException as exc:
+        error = exc
+        raise
+    finally:
+        report.stop()
+        finish_report(run_report, error, project_config, args)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import os
+
+"""
+Resource usage of tap and target processes of a sync, sampled from /proc (Linux only)
+by a coroutine of their pipeline (see singer_aws.engine): resident memory (RSS), CPU time
+and bytes read from / written to storage, of every process together with the processes
+it started. Peaks are logged once the sync ends.
+
+Limits (`max_rss_bytes`, `max_cpu_seconds`) can be set for a tap or a target in
+singer_project_config.yml. When a process exceeds its limit, the tap is stopped (SIGTERM),
+so that the target receives the end of its input, loads what it has and emits its final
+state, which is saved as usual, instead of the whole host running out of memory.
+"""
+
+PROC_PATH = "/proc"
+
+# seconds between samples of resource usage
+MONITOR_INTERVAL = 1
+
+# properties of a tap or target limiting resources of its process
+LIMITS = ['max_rss_bytes', 'max_cpu_seconds']
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def available():
+    """
+    Whether resource usage can be read on this system.
+    """
+    return(os.path.exists(os.path.join(PROC_PATH, "self", "stat")))
+
+
+def process_tree(pid):
+    """
+    pid and pids of all its descendants (e.g. a shell wrapper of a tap and the tap itself).
+    """
+
+    pids = [pid]
+    for parent in pids:
+        try:
+            tasks = os.listdir(os.path.join(PROC_PATH, str(parent), "task"))
+        except OSError:
+            continue
+        for task in tasks:
+            try:
+                with open(os.path.join(PROC_PATH, str(parent), "task", task, "children")) as fh:
+                    pids.extend(int(child) for child in fh.read().split())
+            except OSError:
+                pass
+    return(pids)
+
+
+def read_usage(pid):
+    """
+    Resource usage of a single process: RSS (bytes), CPU time (seconds, incl. its children
+    which exited) and bytes read/written from storage. None if the process doesn't exist anymore.
+    """
+
+    try:
+        with open(os.path.join(PROC_PATH, str(pid), "stat")) as fh:
+            # fields after the command, which may contain spaces and parentheses
+            fields = fh.read().rsplit(")", 1)[1].split()
+        with open(os.path.join(PROC_PATH, str(pid), "statm")) as fh:
+            rss_pages = int(fh.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return(None)
+
+    usage = {
+        "rss_bytes": rss_pages * PAGE_SIZE,
+        "cpu_seconds": sum(int(field) for field in fields[11:15]) / CLOCK_TICKS,
+        "read_bytes": 0,
+        "write_bytes": 0,
+        }
+    try:
+        with open(os.path.join(PROC_PATH, str(pid), "io")) as fh:
+            for line in fh:
+                key, _, value = line.partition(":")
+                if key in ("read_bytes", "write_bytes"):
+                    usage[key] = int(value)
+    except OSError:
+        # not readable e.g. in some containers
+        pass
+    return(usage)
+
+
+class ResourceMonitor:
+    """
+    Samples resource usage of processes (name -> asyncio process) every `interval` seconds,
+    keeping peaks per process. limits map a name to its LIMITS; once a process exceeds one of them,
+    on_limit(name, reason) is called (once per monitor) and `exceeded` holds the reason.
+    The pipeline also calls sample() whenever one of the processes exits (see
+    singer_aws.engine.Pipeline.on_exit), so that peaks of short runs are not missed.
+    """
+
+    def __init__(self, processes, limits=None, interval=MONITOR_INTERVAL, on_limit=None):
+        self.processes = processes
+        self.limits = limits or {}
+        self.interval = interval
+        self.on_limit = on_limit
+        self.peaks = {name: None for name in processes}
+        self.exceeded = None
+
+    def sample(self):
+        for name, proc in self.processes.items():
+            if proc.returncode is not None:
+                continue
+            usages = [usage for usage in map(read_usage, process_tree(proc.pid)) if usage is not None]
+            if not usages:
+                continue
+            usage = {key: sum(usage[key] for usage in usages) for key in usages[0]}
+            peak = self.peaks[name]
+            if peak is None:
+                self.peaks[name] = peak = usage
+            else:
+                # CPU and I/O only grow, but may drop when a child process exits
+                for key, value in usage.items():
+                    peak[key] = max(peak[key], value)
+            self.check_limits(name, usage)
+
+    def check_limits(self, name, usage):
+        if self.exceeded is not None:
+            return
+        limits = self.limits.get(name) or {}
+        reason = None
+        if limits.get('max_rss_bytes') and usage["rss_bytes"] > limits['max_rss_bytes']:
+            reason = f"{name} uses {usage['rss_bytes']} bytes of memory, over its max_rss_bytes {limits['max_rss_bytes']}"
+        elif limits.get('max_cpu_seconds') and usage["cpu_seconds"] > limits['max_cpu_seconds']:
+            reason = f"{name} used {usage['cpu_seconds']:.1f}s of CPU, over its max_cpu_seconds {limits['max_cpu_seconds']}"
+        if reason is not None:
+            self.exceeded = reason
+            if self.on_limit is not None:
+                self.on_limit(name, reason)
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def summary(self):
+        """
+        Log peak resource usage of every process. Returns the peaks.
+        """
+
+        for name, peak in self.peaks.items():
+            if peak is None:
+                continue
+            logging.info(
+                f"resources of {name}: peak RSS {peak['rss_bytes'] / 1024 / 1024:.1f}MB, "
+                f"CPU {peak['cpu_seconds']:.1f}s, read {peak['read_bytes']} bytes from disk, wrote {peak['write_bytes']} bytes to disk."
+                )
+        return(self.peaks)
@@ -0,0 +1,181 @@
+import json
+import logging
+import os
+from singer_aws import engine
+from singer_aws.catalog import catalog_index, load_catalog
+from singer_aws.pipe import build_stages
+from singer_aws.sync import get_state, merge_states, prune_states, run_sync, send_state, singer_home, states_in_path, sync
+
+"""
+Per-stream parallel sync: selected streams of a tap catalog are split into K partitions,
+each of them replicated by its own tap process, so that a single big stream doesn't hold
+all the small ones back.
+
+Every partition gets its own catalog (its selected streams only) and its own state (bookmarks
+of its streams only), stored in taps/tap-name/partitions/. Messages of all tap processes are
+merged into a single target, or, with --partition-targets, every tap process loads into its
+own target process. Either way, bookmarks emitted for every partition are merged on top of
+the state the sync started from, and uploaded to S3 as a single state.
+
+Streams are spread over partitions by their weight (`stream_weights` property of the tap in
+singer_project_config.yml, 1 by default), heaviest first, each into the lightest partition.
+"""
+
+
+def partition_streams(index, count, weights=None):
+    """
+    Split selected streams of a compiled catalog (see catalog_index) into up to `count` lists of stream ids.
+    """
+
+    weights = weights or {}
+    stream_ids = [stream_id for stream_id, stream in index['streams'].items() if stream['selected']]
+    stream_ids.sort(key=lambda stream_id: -weights.get(stream_id, 1))
+
+    partitions = [[] for _ in range(min(count, len(stream_ids)))]
+    loads = [0] * len(partitions)
+    for stream_id in stream_ids:
+        i = loads.index(min(loads))
+        partitions[i].append(stream_id)
+        loads[i] += weights.get(stream_id, 1)
+
+    return(partitions)
+
+
+def partition_state(state, stream_ids):
+    """
+    State of a tap limited to bookmarks of given streams, so that a tap process emits only those.
+    """
+
+    state = dict(state)
+    state['bookmarks'] = {
+        stream_id: bookmark for stream_id, bookmark in (state.get('bookmarks') or {}).items()
+        if stream_id in stream_ids
+        }
+    if state.get('currently_syncing') not in stream_ids:
+        state.pop('currently_syncing', None)
+    return(state)
+
+
+def write_partitions(tap, project_config, count, base_state=None):
+    """
+    Write a catalog (and a state, if base_state is passed) per partition of a tap to taps/tap-name/partitions/.
+    Returns list of partitions (see singer_aws.sync.sync) with their name and stream ids.
+    """
+
+    catalog_path = os.path.join(singer_home, f"taps/tap-{tap}/catalog.json")
+    weights = (project_config['taps'].get(f"tap-{tap}") or {}).get('stream_weights')
+    stream_partitions = partition_streams(catalog_index(catalog_path), count, weights)
+    if not stream_partitions:
+        raise ValueError(f"ERROR: no streams of tap-{tap} are selected, nothing to partition.")
+
+    catalog = load_catalog(catalog_path)
+    os.makedirs(os.path.join(singer_home, f"taps/tap-{tap}/partitions"), exist_ok=True)
+
+    partitions = []
+    for i, stream_ids in enumerate(stream_partitions):
+        name = f"streams-{i:03d}"
+        partition = {
+            "name": name,
+            "streams": stream_ids,
+            "catalog": f"taps/tap-{tap}/partitions/{name}-catalog.json",
+            "state": None,
+            }
+        with open(os.path.join(singer_home, partition["catalog"]), 'w') as fh:
+            json.dump({"streams": [stream for stream in catalog['streams'] if stream['tap_stream_id'] in stream_ids]}, fh)
+        if base_state is not None:
+            partition["state"] = f"taps/tap-{tap}/partitions/{name}-state.json"
+            with open(os.path.join(singer_home, partition["state"]), 'w') as fh:
+                json.dump(partition_state(base_state, stream_ids), fh)
+        logging.info(f"tap-{tap} {name}: {', '.join(stream_ids)}")
+        partitions.append(partition)
+
+    return(partitions)
+
+
+def cleanup_partitions(tap):
+    """
+    Remove catalogs and states of partitions of a tap.
+    """
+
+    partitions_path = os.path.join(singer_home, f"taps/tap-{tap}/partitions")
+    if not os.path.isdir(partitions_path):
+        return
+    for name in os.listdir(partitions_path):
+        os.remove(os.path.join(partitions_path, name))
+    os.rmdir(partitions_path)
+
+
+def partitioned_sync(tap, target, project_config, bucket, args, count, separate_targets=False, ignore_state=False,
+                     aws_profile=None, checkpoint_seconds=None, checkpoint_states=None, target_config_path=None):
+    """
+    Sync selected streams of a tap split into `count` partitions, run by concurrent tap processes
+    loading into a single target, or into a target process each if separate_targets is True.
+    """
+
+    tap_name = f"tap-{tap}"
+    if not project_config['taps'].get(tap_name).get('catalog_arg'):
+        raise ValueError(f"ERROR: {tap_name} has no catalog_arg, its streams can't be partitioned.")
+
+    base_state = {}
+    if not ignore_state and get_state(tap_name, project_config, bucket, aws_profile):
+        with open(os.path.join(states_in_path, f"{tap_name}-state.json")) as fh:
+            base_state = json.load(fh)
+
+    try:
+        partitions = write_partitions(tap, project_config, count, base_state if not ignore_state else None)
+        logging.info(f"RUNNING: {tap_name} in {len(partitions)} partitions"
+                     f"{', each into its own target' if separate_targets else ''}.")
+
+        if not separate_targets:
+            stages = build_stages(tap_name, project_config, args)
+            sync(tap, target, project_config, bucket, ignore_state, aws_profile, checkpoint_seconds,
+                 checkpoint_states, target_config_path, stages, partitions=partitions, base_state=base_state,
+                 prune_catalog=getattr(args, 'prune_catalog', None), timeout=getattr(args, 'timeout_seconds', None))
+            return
+
+        # fail before any partition starts if stages can't be built (e.g. --spool)
+        build_stages(tap_name, project_config, args, part="partition")
+        states = []
+        failed = []
+        for partition, result in run_partitions(tap, target, project_config, bucket, args, partitions,
+                                                aws_profile, target_config_path):
+            if isinstance(result, BaseException):
+                failed.append(partition["name"])
+            elif result is not None:
+                states.append(json.loads(result))
+    finally:
+        cleanup_partitions(tap)
+
+    # streams of failed partitions keep bookmarks the sync started from
+    if states:
+        send_state(tap_name, project_config, bucket, aws_profile, state=json.dumps(merge_states([base_state] + states)))
+        state_retention = project_config.get('state_retention')
+        if state_retention:
+            prune_states(tap_name, project_config, bucket, state_retention, aws_profile)
+
+    if failed:
+        raise ValueError(f"ERROR: {tap_name} partitions failed: {', '.join(failed)}.")
+    logging.info(f"SUCCESS: {tap_name} sync of {len(partitions)} partitions succeeded.")
+
+
+def run_partitions(tap, target, project_config, bucket, args, partitions, aws_profile=None, target_config_path=None):
+    """
+    Run a "tap | target" pipeline per partition, all at once on a single event loop, without
+    uploading their states.
+    Returns list of (partition, last state of the target or exception raised by the sync).
+    """
+
+    async def run(partition):
+        stages = build_stages(f"tap-{tap}", project_config, args, part=partition["name"])
+        states = await run_sync(tap, target, project_config, bucket, True, aws_profile,
+                                target_config_path=target_config_path, stages=stages, part=partition["name"],
+                                send_states=False, partitions=[partition], prune_catalog=getattr(args, 'prune_catalog', None),
+                                timeout=getattr(args, 'timeout_seconds', None))
+        return(states[target])
+
+    results = list(zip(partitions, engine.run_many([run(partition) for partition in partitions])))
+    for partition, result in results:
+        if isinstance(result, BaseException):
+            # SystemExit included, raised by sync when e.g. S3 is not reachable
+            logging.error(f"ERROR: tap-{tap} {partition['name']} failed: {result!r}")
+    return(results)
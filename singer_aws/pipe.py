@@ -0,0 +1,620 @@
+import gzip
+import hashlib
+import json
+import logging
+from itertools import chain
+import os
+import re
+import shutil
+import tempfile
+from singer_aws.catalog import allowed_properties, catalog_index
+from singer_aws.report import note
+import time
+
+try:
+    # optional, considerably faster JSON codec for stages rewriting messages
+    import orjson
+except ImportError:
+    orjson = None
+
+"""
+In-process stages between a Singer Tap and a Singer Target. When any stage is
+enabled, stdout of the tap is not handed to the target directly, but relayed
+line by line (one Singer message per line) through a chain of stages into stdin
+of the target (see singer_aws.engine).
+
+A stage receives a message as bytes and returns a list (or any iterable) of messages
+to pass on (empty to drop it). Stages must be cheap: where possible they look only at the
+beginning of a message (see message_type) instead of decoding it from JSON.
+"""
+
+singer_home = os.getcwd()
+metrics_path = os.path.join(singer_home, 'metrics')
+spool_path = os.path.join(singer_home, 'spool')
+spill_path = os.path.join(singer_home, 'spill')
+
+# size of uncompressed messages written into a single chunk of a spool
+SPOOL_CHUNK_BYTES = 64 * 1024 * 1024
+
+# size of messages buffered in memory for every target when a tap fans out to several
+# targets (or when buffering is enabled, see singer_aws.engine.TargetFeed)
+FAN_OUT_BUFFER_BYTES = 16 * 1024 * 1024
+
+# size of spilled messages read back at once
+SPILL_READ_BYTES = 1024 * 1024
+
+# size of records held in memory by compaction (see CompactStage) between STATE messages
+COMPACT_MEMORY_BYTES = 64 * 1024 * 1024
+
+# Singer messages are serialized with "type" (and "stream") keys first, so they can be
+# found at the beginning of a message, without decoding the whole message
+MESSAGE_PREFIX_BYTES = 256
+TYPE_PATTERN = re.compile(rb'"type"\s*:\s*"([A-Z_]+)"')
+STREAM_PATTERN = re.compile(rb'"stream"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+def message_type(line):
+    """
+    Return (type, stream) of a Singer message, scanning only beginning of the message
+    and falling back to JSON decoding when keys are not found there.
+    stream is None for messages without a stream (e.g. STATE).
+    """
+
+    prefix = line[:MESSAGE_PREFIX_BYTES]
+    type_match = TYPE_PATTERN.search(prefix)
+    stream_match = STREAM_PATTERN.search(prefix)
+
+    if type_match is not None and (stream_match is not None or type_match.group(1) == b"STATE"):
+        stream = stream_match.group(1).decode() if stream_match is not None else None
+        return(type_match.group(1).decode(), stream)
+
+    try:
+        message = json.loads(line)
+    except ValueError:
+        return(None, None)
+    return(message.get('type'), message.get('stream'))
+
+
+def loads(line):
+    """
+    Decode a Singer message, with orjson if it's installed.
+    """
+
+    if orjson is not None:
+        try:
+            return(orjson.loads(line))
+        except orjson.JSONDecodeError:
+            # e.g. integers exceeding 64 bits, which json module handles
+            pass
+    return(json.loads(line))
+
+
+def dumps(message):
+    """
+    Encode a Singer message as a line of bytes, with orjson if it's installed.
+    """
+
+    if orjson is not None:
+        try:
+            return(orjson.dumps(message) + b"\n")
+        except TypeError:
+            pass
+    return(json.dumps(message, separators=(',', ':')).encode() + b"\n")
+
+
+class Stage:
+    """
+    Base class of stages, passing every message on unchanged.
+    """
+
+    def process(self, line):
+        return([line])
+
+    def close(self):
+        """
+        Called once the tap has finished; returns messages still held by the stage.
+        """
+        return([])
+
+    def finish(self, tap_returncode, target_returncode):
+        """
+        Called once both the tap and the target have exited.
+        """
+        pass
+
+
+class StateMergeStage(Stage):
+    """
+    Merges STATE messages of several taps replicating disjoint sets of streams (see
+    singer_aws.partition) on top of base_state, so that every state passed to the target holds
+    bookmarks of all streams.
+    """
+
+    def __init__(self, tap, base_state=None):
+        self.tap = tap
+        self.state = base_state or {}
+        self.relay = None
+
+    def process(self, line):
+        type, _ = message_type(line)
+        if type != "STATE":
+            return([line])
+
+        # imported here, as singer_aws.sync depends on this module
+        from singer_aws.sync import merge_states
+
+        self.state = merge_states([self.state, loads(line).get('value') or {}])
+        return([dumps({"type": "STATE", "value": self.state})])
+
+
+class MeterStage(Stage):
+    """
+    Counts messages, records and bytes per stream, logs progress every `interval`
+    seconds and writes a JSON summary of the sync to metrics/<tap>-metrics.json.
+    """
+
+    def __init__(self, tap, interval=60):
+        self.tap = tap
+        self.interval = interval
+        self.started = time.monotonic()
+        self.next_progress = self.started + interval
+        self.messages = {}
+        self.streams = {}
+        self.bytes = 0
+        self.lines = 0
+        self.relay = None
+
+    def process(self, line):
+        type, stream = message_type(line)
+        size = len(line)
+
+        self.lines += 1
+        self.bytes += size
+        self.messages[type] = self.messages.get(type, 0) + 1
+
+        if type == "RECORD":
+            counts = self.streams.get(stream)
+            if counts is None:
+                counts = self.streams[stream] = {"records": 0, "bytes": 0}
+            counts["records"] += 1
+            counts["bytes"] += size
+
+        # checking the clock for every message would be noticeable with tiny records
+        if self.lines % 1000 == 0 and time.monotonic() >= self.next_progress:
+            self.next_progress += self.interval
+            self.log_progress()
+
+        return([line])
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        records = sum(counts["records"] for counts in self.streams.values())
+        summary = {
+            "tap": self.tap,
+            "elapsed_seconds": round(elapsed, 3),
+            "records": records,
+            "bytes": self.bytes,
+            "records_per_second": round(records / elapsed, 1) if elapsed else None,
+            "bytes_per_second": round(self.bytes / elapsed, 1) if elapsed else None,
+            "messages": self.messages,
+            "streams": self.streams,
+        }
+        if self.relay is not None:
+            summary["tap_wait_seconds"] = round(self.relay.read_seconds, 3)
+            summary["target_wait_seconds"] = round(self.relay.write_seconds, 3)
+        return(summary)
+
+    def log_progress(self):
+        summary = self.summary()
+        logging.info(
+            f"PROGRESS: {self.tap} {summary['records']} records, {summary['bytes']} bytes "
+            f"({summary['records_per_second']} records/s, {summary['bytes_per_second']} bytes/s), "
+            f"waited {summary.get('tap_wait_seconds')}s for tap, {summary.get('target_wait_seconds')}s for target"
+            )
+
+    def close(self):
+        self.log_progress()
+        os.makedirs(metrics_path, exist_ok=True)
+        path = os.path.join(metrics_path, f"{self.tap}-metrics.json")
+        with open(path, "w") as fh:
+            json.dump(self.summary(), fh, indent=2)
+        logging.info(f"SUCCESS: metrics of {self.tap} written to {path}.")
+        return([])
+
+
+class ProjectStage(Stage):
+    """
+    Drops properties not selected in the catalog from RECORD and SCHEMA messages
+    of selected streams, so that the target doesn't parse and validate them.
+    Messages which contain only selected properties are passed on unchanged.
+    """
+
+    def __init__(self, tap, allowed):
+        self.tap = tap
+        self.allowed = allowed
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.rewritten = 0
+
+    @classmethod
+    def from_catalog(cls, tap, path):
+        return(cls(tap, allowed_properties(catalog_index(path))))
+
+    def process(self, line):
+        self.bytes_in += len(line)
+        type, stream = message_type(line)
+        allowed = self.allowed.get(stream)
+
+        if allowed is not None and type == "RECORD":
+            message = loads(line)
+            record = message['record']
+            if not record.keys() <= allowed:
+                message['record'] = {key: value for key, value in record.items() if key in allowed}
+                line = dumps(message)
+                self.rewritten += 1
+
+        elif allowed is not None and type == "SCHEMA":
+            message = loads(line)
+            schema = message['schema']
+            properties = schema.get('properties', {})
+            if not properties.keys() <= allowed:
+                schema['properties'] = {key: value for key, value in properties.items() if key in allowed}
+                if 'required' in schema:
+                    schema['required'] = [key for key in schema['required'] if key in allowed]
+                line = dumps(message)
+                self.rewritten += 1
+
+        self.bytes_out += len(line)
+        return([line])
+
+    def close(self):
+        saved = self.bytes_in - self.bytes_out
+        ratio = saved / self.bytes_in if self.bytes_in else 0
+        logging.info(
+            f"SUCCESS: unselected properties of {self.tap} dropped from {self.rewritten} messages, "
+            f"{saved} of {self.bytes_in} bytes ({ratio:.1%}) not sent to the target."
+            )
+        return([])
+
+
+class SchemaDedupStage(Stage):
+    """
+    Drops SCHEMA messages identical to the previous SCHEMA message of the same stream
+    (re-emitted by some taps before every page of records), so that the target doesn't
+    process the same schema again. Every other message is passed on in its order.
+    """
+
+    def __init__(self, tap):
+        self.tap = tap
+        self.hashes = {}
+        self.dropped = {}
+
+    def process(self, line):
+        type, stream = message_type(line)
+        if type != "SCHEMA":
+            return([line])
+
+        digest = hashlib.sha256(line.rstrip()).digest()
+        if self.hashes.get(stream) == digest:
+            self.dropped[stream] = self.dropped.get(stream, 0) + 1
+            return([])
+        self.hashes[stream] = digest
+        return([line])
+
+    def close(self):
+        note(f"schema_dedup:{self.tap}", self.dropped)
+        if self.dropped:
+            streams = ", ".join(f"{stream}: {count}" for stream, count in sorted(self.dropped.items()))
+            logging.info(f"SUCCESS: {sum(self.dropped.values())} repeated SCHEMA messages of {self.tap} dropped ({streams}).")
+        else:
+            logging.info(f"SUCCESS: no repeated SCHEMA messages of {self.tap} found.")
+        return([])
+
+
+class CompactStage(Stage):
+    """
+    Holds RECORD messages of streams with key_properties (from their SCHEMA messages)
+    until the next STATE (or any other non-RECORD) message, passing on only the latest
+    version of every key, so that the target doesn't load records superseded within
+    the same run (e.g. re-extracted by lookback windows of incremental streams). As
+    records are held only between messages the target acts upon, state emitted by the
+    target is unchanged. Records beyond memory_bytes are spilled to a temporary file in
+    spill_path, up to spill_bytes; beyond that, held records are passed on early.
+    """
+
+    def __init__(self, tap, memory_bytes=COMPACT_MEMORY_BYTES, spill_bytes=None):
+        self.tap = tap
+        self.memory_bytes = memory_bytes
+        self.spill_bytes = spill_bytes
+        self.key_properties = {}
+        # (stream, *key) -> latest record, as a line or as (offset, size) in the spill file
+        self.held = {}
+        self.held_bytes = 0
+        self.spill = None
+        self.spill_size = 0
+        self.records = 0
+        self.superseded = 0
+        self.bytes_saved = 0
+        self.spilled = 0
+        self.early_flushes = 0
+
+    def process(self, line):
+        type, stream = message_type(line)
+
+        if type != "RECORD":
+            lines = self.flush()
+            if type == "SCHEMA":
+                self.key_properties[stream] = loads(line).get('key_properties') or []
+            return(chain(lines, [line]))
+
+        key_properties = self.key_properties.get(stream)
+        if not key_properties:
+            return([line])
+        record = loads(line).get('record') or {}
+        try:
+            key = (stream,) + tuple(record[name] for name in key_properties)
+            previous = self.held.pop(key, None)
+        except (KeyError, TypeError):
+            # records without a (hashable) key are passed on as they are
+            return([line])
+
+        self.records += 1
+        if previous is not None:
+            self.superseded += 1
+            if isinstance(previous, tuple):
+                self.bytes_saved += previous[1]
+            else:
+                self.bytes_saved += len(previous)
+                self.held_bytes -= len(previous)
+
+        lines = []
+        size = len(line)
+        if self.held_bytes + size > self.memory_bytes:
+            if self.spill_bytes and self.spill_size + size <= self.spill_bytes:
+                self.held[key] = self.write_spill(line)
+                return(lines)
+            lines = self.flush()
+            self.early_flushes += 1
+        self.held[key] = line
+        self.held_bytes += size
+        return(lines)
+
+    def write_spill(self, line):
+        if self.spill is None:
+            os.makedirs(spill_path, exist_ok=True)
+            self.spill = tempfile.TemporaryFile(dir=spill_path, prefix=f"{self.tap}-compact-")
+        offset = self.spill_size
+        os.pwrite(self.spill.fileno(), line, offset)
+        self.spill_size += len(line)
+        self.spilled += len(line)
+        return((offset, len(line)))
+
+    def flush(self):
+        """
+        Return held records (in the order of their latest versions) and forget them. Spilled
+        records are read back lazily, while the relay writes them into the target.
+        """
+
+        held, spill = self.held, self.spill
+        self.held = {}
+        self.held_bytes = 0
+        self.spill = None
+        self.spill_size = 0
+        return(self.read_held(held, spill))
+
+    def read_held(self, held, spill):
+        for entry in held.values():
+            if isinstance(entry, tuple):
+                offset, size = entry
+                yield os.pread(spill.fileno(), size, offset)
+            else:
+                yield entry
+        if spill is not None:
+            spill.close()
+
+    def summary(self):
+        return({
+            "records": self.records,
+            "superseded_records": self.superseded,
+            "bytes_saved": self.bytes_saved,
+            "spilled_bytes": self.spilled,
+            "early_flushes": self.early_flushes,
+        })
+
+    def close(self):
+        lines = self.flush()
+        note(f"compaction:{self.tap}", self.summary())
+        ratio = self.superseded / self.records if self.records else 0
+        logging.info(
+            f"SUCCESS: {self.superseded} of {self.records} keyed records of {self.tap} ({ratio:.1%}, "
+            f"{self.bytes_saved} bytes) superseded by later versions of their keys and not sent to the target, "
+            f"{self.spilled} bytes spilled to disk, {self.early_flushes} early flushes."
+            )
+        return(lines)
+
+
+class SpoolStage(Stage):
+    """
+    Tees messages of the tap into gzip-compressed chunks of a spool directory
+    (spool/<tap>/<run_id>/part-NNNNN.jsonl.gz), so that they can be replayed into
+    the target (singer-aws-replay) without running the tap again, e.g. when the
+    target fails. A manifest.json describing the spool is written once the tap
+    and the target exit. Spool is deleted if the sync succeeds, unless keep is set;
+    if upload (a callable taking local path and relative key) is passed, chunks and
+    manifest are uploaded with it (the spool is kept locally if that fails).
+    """
+
+    def __init__(self, tap, chunk_bytes=SPOOL_CHUNK_BYTES, keep=False, upload=None):
+        self.tap = tap
+        self.run_id = str(int(time.time()*1000))
+        self.path = os.path.join(spool_path, tap, self.run_id)
+        self.chunk_bytes = chunk_bytes
+        self.keep = keep
+        self.upload = upload
+        self.parts = []
+        self.lines = 0
+        self.bytes = 0
+        self.chunk = None
+        self.chunk_size = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def open_chunk(self):
+        name = f"part-{len(self.parts):05d}.jsonl.gz"
+        self.parts.append(name)
+        # low compression level keeps up with fast taps, Singer messages compress well anyway
+        self.chunk = gzip.open(os.path.join(self.path, name), "wb", compresslevel=1)
+        self.chunk_size = 0
+
+    def process(self, line):
+        if self.chunk is None or self.chunk_size >= self.chunk_bytes:
+            if self.chunk is not None:
+                self.chunk.close()
+            self.open_chunk()
+        self.chunk.write(line)
+        self.chunk_size += len(line)
+        self.lines += 1
+        self.bytes += len(line)
+        return([line])
+
+    def close(self):
+        if self.chunk is not None:
+            self.chunk.close()
+        return([])
+
+    def finish(self, tap_returncode, target_returncode):
+        manifest = {
+            "tap": self.tap,
+            "run_id": self.run_id,
+            "parts": self.parts,
+            "lines": self.lines,
+            "bytes": self.bytes,
+            # spool of a failed tap holds only part of its output and can't be replayed
+            "complete": tap_returncode == 0,
+            "target_returncode": target_returncode,
+        }
+        with open(os.path.join(self.path, "manifest.json"), "w") as fh:
+            json.dump(manifest, fh, indent=2)
+
+        uploaded = True
+        if self.upload is not None:
+            try:
+                for name in self.parts + ["manifest.json"]:
+                    self.upload(os.path.join(self.path, name), f"{self.run_id}/{name}")
+            except Exception as exc:
+                # the spool is optional, a failed upload mustn't lose state loaded by the target
+                logging.error(f"ERROR: spool of {self.tap} wasn't uploaded, it's kept in {self.path}: {exc!r}")
+                uploaded = False
+
+        if target_returncode == 0 and tap_returncode == 0 and not self.keep and uploaded:
+            shutil.rmtree(self.path, ignore_errors=True)
+        else:
+            logging.info(f"messages of {self.tap} spooled to {self.path}, replay them with singer-aws-replay.")
+
+
+class SpoolReader:
+    """
+    Reads messages of a spool directory written by SpoolStage, chunk by chunk.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "manifest.json")) as fh:
+            self.manifest = json.load(fh)
+        if not self.manifest['complete']:
+            raise ValueError(f"ERROR: spool {path} is incomplete (its tap failed) and can't be replayed.")
+        self.paths = [os.path.join(path, name) for name in self.manifest['parts']]
+        self.chunk = None
+
+    def readline(self):
+        while True:
+            if self.chunk is None:
+                if not self.paths:
+                    return(b"")
+                self.chunk = gzip.open(self.paths.pop(0), "rb")
+            line = self.chunk.readline()
+            if line:
+                return(line)
+            self.chunk.close()
+            self.chunk = None
+
+    def close(self):
+        if self.chunk is not None:
+            self.chunk.close()
+
+
+def latest_spool(tap):
+    """
+    Path of the most recent spool of a tap (tap name with tap- prefix), None if there is none.
+    """
+
+    try:
+        run_ids = [run_id for run_id in os.listdir(os.path.join(spool_path, tap)) if run_id.isdigit()]
+    except OSError:
+        return(None)
+    if not run_ids:
+        return(None)
+    return(os.path.join(spool_path, tap, max(run_ids, key=int)))
+
+
+def build_stages(tap, project_config, args, part=None):
+    """
+    Build stages enabled for a tap by command arguments or by singer_project_config.yml
+    (properties of the tap override global ones). tap is the tap name with tap- prefix.
+    part names one of several tap processes of a single sync (see singer_aws.sync.sync),
+    each of them metered separately. Such syncs can't be spooled, as a spool replays a
+    whole sync.
+    """
+
+    tap_config = project_config['taps'].get(tap) or {}
+
+    def option(name, default=None):
+        value = getattr(args, name, None)
+        if value is None:
+            value = tap_config.get(name, project_config.get(name, default))
+        return(value)
+
+    stages = []
+
+    if option('spool', False):
+        if part is not None:
+            raise ValueError(f"ERROR: {tap} can't be spooled when run as several tap processes.")
+        upload = None
+        if option('spool_upload', False):
+            upload = spool_uploader(tap, project_config)
+        stages.append(SpoolStage(tap, option('spool_chunk_bytes', SPOOL_CHUNK_BYTES), option('spool_keep', False), upload))
+
+    if option('meter', False):
+        stages.append(MeterStage(tap if part is None else f"{tap}-part-{part}", option('meter_interval', 60)))
+
+    if option('drop_unselected', False):
+        stages.append(ProjectStage.from_catalog(tap, os.path.join(singer_home, f"taps/{tap}/catalog.json")))
+
+    if option('dedup_schemas', False):
+        stages.append(SchemaDedupStage(tap if part is None else f"{tap}-part-{part}"))
+
+    if option('compact', False):
+        # last, so that it holds records as they are sent to the target
+        stages.append(CompactStage(tap if part is None else f"{tap}-part-{part}",
+                                   option('compact_memory_bytes', COMPACT_MEMORY_BYTES), option('compact_spill_bytes')))
+
+    return(stages)
+
+
+def spool_prefix(tap):
+    """
+    S3 prefix under which spools of a given tap are uploaded.
+    """
+    return(f"singer/{tap}/spool/")
+
+
+def spool_uploader(tap, project_config):
+    """
+    Callable uploading files of a spool to the data bucket of the project.
+    """
+
+    def upload(path, key):
+        # imported here, as singer_aws.sync depends on this module
+        from singer_aws.sync import s3_client
+        s3 = s3_client(project_config, project_config.get('redshift_aws_profile'))
+        s3.upload_file(path, project_config.get('data_bucket'), f"{spool_prefix(tap)}{key}")
+
+    return(upload)
@@ -1,8 +1,11 @@
-import boto3
+import hashlib
 import json
 import logging
 import os
-import yaml
+from singer_aws import aws
+from singer_aws.cache import cache_dir, write_private
+from singer_aws.report import phase
+import threading
 
 # LOGGER = logging.getLogger('singer_logger')
 # logging.setLevel(getattr(logging, 'INFO'))
@@ -19,14 +22,130 @@ The order of proceeding when preparing singer config file (applies to both tap a
     `/ssm_prefix/TAP_TAPNAME_CONFIG` or `/ssm_prefix/TARGET_TARGETNAME_CONFIG`.
     Value of ssm_prefix is configurable from singer_project_config.yml file, e.g.
     `/acme_singer_project/`
+
+SSM parameters are fetched in batches (see prefetch_configs) and kept in memory for
+the whole run. If `ssm_cache_ttl` (seconds) is set in singer_project_config.yml and
+SINGER_AWS_CACHE_KEY env variable holds a Fernet key (requires `cryptography` package),
+they're also cached on disk, encrypted, for that long.
 """
 
+# max number of names accepted by a single SSM GetParameters request
+SSM_BATCH_SIZE = 10
+
+_ssm_lock = threading.Lock()
+_ssm_parameters = {}
+
+
+def ssm_parameter_name(kind, name, project_config):
+    """
+    Name of SSM parameter holding config of a tap or target, e.g. /ssm_prefix/TAP_ADWORDS_CONFIG.
+    """
+
+    ssm_prefix = project_config.get('ssm_prefix')
+    return(f"{ssm_prefix}/{kind.upper()}_{name.upper().replace('-', '_')}_CONFIG")
+
+
+def _ssm_cache():
+    """
+    Fernet instance used to encrypt SSM parameters cached on disk, None if disk cache is disabled.
+    """
+
+    key = os.getenv('SINGER_AWS_CACHE_KEY')
+    if key is None:
+        return(None)
+    try:
+        from cryptography.fernet import Fernet
+    except ImportError:
+        logging.warning("cryptography package is not installed, SSM parameters won't be cached on disk.")
+        return(None)
+    return(Fernet(key))
+
+
+def _ssm_cache_path(name):
+    return(os.path.join(cache_dir('ssm'), f"{hashlib.sha256(name.encode()).hexdigest()[:32]}.enc"))
+
+
+def _read_ssm_cache(fernet, name, ttl):
+    from cryptography.fernet import InvalidToken
+    try:
+        with open(_ssm_cache_path(name), 'rb') as fh:
+            return(fernet.decrypt(fh.read(), ttl=ttl).decode())
+    except (OSError, InvalidToken):
+        # missing, expired or encrypted with another key
+        return(None)
+
+
+def prefetch_ssm_parameters(names, project_config):
+    """
+    Fetch SSM parameters not fetched yet, in batches of SSM_BATCH_SIZE names per request,
+    and keep them in memory. Parameters that don't exist are remembered as None.
+    """
+
+    ttl = project_config.get('ssm_cache_ttl')
+    fernet = _ssm_cache() if ttl else None
+
+    with _ssm_lock:
+        missing = [name for name in dict.fromkeys(names) if name not in _ssm_parameters]
+
+        if fernet is not None:
+            for name in list(missing):
+                value = _read_ssm_cache(fernet, name, ttl)
+                if value is not None:
+                    _ssm_parameters[name] = value
+                    missing.remove(name)
+
+        if not missing:
+            return
+
+        ssm = aws.client('ssm')
+        for i in range(0, len(missing), SSM_BATCH_SIZE):
+            batch = missing[i:i+SSM_BATCH_SIZE]
+            with phase("ssm_get_parameters"):
+                response = ssm.get_parameters(Names=batch, WithDecryption=True)
+            for elem in response.get('Parameters', []):
+                _ssm_parameters[elem['Name']] = elem['Value']
+                if fernet is not None:
+                    write_private(_ssm_cache_path(elem['Name']), fernet.encrypt(elem['Value'].encode()).decode())
+            for name in response.get('InvalidParameters', []):
+                _ssm_parameters[name] = None
+
+        logging.info(f"{len(missing)} SSM parameters fetched in {-(-len(missing) // SSM_BATCH_SIZE)} requests.")
+
+
+def get_ssm_parameter(name, project_config):
+    """
+    Value of SSM parameter (fetched once per run), None if it doesn't exist.
+    """
+
+    prefetch_ssm_parameters([name], project_config)
+    return(_ssm_parameters.get(name))
+
+
+def prefetch_configs(taps, targets, project_config):
+    """
+    Fetch SSM parameters of all taps and targets of a run at once, skipping those
+    whose config is provided as a file or env variable.
+    """
+
+    names = []
+    for tap in taps:
+        if not os.path.exists(f"taps/tap-{tap.lower()}/config.json") and \
+                os.getenv(f"TAP_{tap.upper().replace('-', '_')}_CONFIG") is None:
+            names.append(ssm_parameter_name('tap', tap, project_config))
+    for target in targets:
+        if not os.path.exists(f"targets/target-{target.lower()}/config.json") and \
+                os.getenv(f"TARGET_{target.upper().replace('-', '_')}_CONFIG") is None:
+            names.append(ssm_parameter_name('target', target, project_config))
+
+    if names:
+        prefetch_ssm_parameters(names, project_config)
+
+
 def fetch_tap_config(tap, project_config):
     """
     Fetches credentials of all Singer Taps from AWS Parameter Store.
     """
 
-    ssm_prefix = project_config.get('ssm_prefix')
     tap_name_upper = tap.upper()
     tap_name_upper_env_var = tap.upper().replace('-', '_')
     tap_name_lower = tap.lower()
@@ -35,6 +154,7 @@ def fetch_tap_config(tap, project_config):
     if os.path.exists(tap_config_path):
         clean_tap_config = False # if tap config was already there and not created by singer-aws, keep it
         logging.info(f"using existing config file for tap-{tap}.")
+        return(clean_tap_config)
 
     elif os.getenv(f"TAP_{tap_name_upper_env_var}_CONFIG") is not None:
 
@@ -45,25 +165,13 @@ def fetch_tap_config(tap, project_config):
 
     else:
 
-        ssm = boto3.client('ssm')
-        # paginator = ssm.get_paginator('get_parameters_by_path')
-
-        # for params in paginator.paginate(Path=ssm_prefix, WithDecryption=True):
-        #     for elem in params.get('Parameters'):
-        #         if f"TAP_{tap_name_upper_env_var}_CONFIG" in elem.get('Name'):
-        #             tap_config = json.loads(elem.get('Value'))
-        #             clean_tap_config = True
-        #             print(f"config for tap-{tap} fetched successfully from SSM.")
-        #         else:
-        #             print(f"ERROR: config for tap-{tap} not provided as file, env var or SSM parameter.")
-
-        try:
-            elem = ssm.get_parameter(Name=f"{ssm_prefix}/TAP_{tap_name_upper_env_var}_CONFIG", WithDecryption=True)['Parameter']
-            tap_config_json = json.loads(elem.get('Value'))
-            clean_tap_config = True
-            logging.info(f"config for tap-{tap} fetched successfully from SSM.")
-        except:
+        tap_config = get_ssm_parameter(ssm_parameter_name('tap', tap, project_config), project_config)
+        if tap_config is None:
             logging.error(f"ERROR: config for tap-{tap} not provided as file, env var or SSM parameter.")
+            raise ValueError(f"ERROR: config for tap-{tap} not found.")
+        tap_config_json = json.loads(tap_config)
+        clean_tap_config = True
+        logging.info(f"config for tap-{tap} fetched successfully from SSM.")
 
     with open(tap_config_path,'w') as fh:
         fh.write(json.dumps(tap_config_json))
@@ -71,13 +179,15 @@ def fetch_tap_config(tap, project_config):
 
     return(clean_tap_config)
 
-def fetch_target_config(target, project_config, tap=None, s3_key_prefix=None):
+def fetch_target_config(target, project_config, tap=None, s3_key_prefix=None, output_path=None):
     """
     Fetches Redshift Singer Target credentials from AWS Parameter Store.
     Can be extended with more targets (e.g. CSV, BigQuery) in the future.
+    Config enriched for a given tap is written to output_path, which defaults to
+    targets/target-name/config.json (pass a tap-specific path when several taps
+    load into the same target concurrently).
     """
 
-    ssm_prefix = project_config.get('ssm_prefix')
     target_name_upper = target.upper()
     target_name_upper_env_var = target.upper().replace('-', '_')
     target_name_lower = target.lower()
@@ -102,17 +212,13 @@ def fetch_target_config(target, project_config, tap=None, s3_key_prefix=None):
 
     else:
 
-        ssm = boto3.client('ssm')
-        paginator = ssm.get_paginator('get_parameters_by_path')
-
-        for params in paginator.paginate(Path=ssm_prefix, WithDecryption=True):
-            for elem in params.get('Parameters'):
-                if f"TARGET_{target_name_upper_env_var}_CONFIG" in elem.get('Name'):
-                    target_config_json = json.loads(elem.get('Value'))
-                    clean_target_config = True
-                    logging.info(f"config for target-{target} fetched successfully from SSM.")
-                else:
-                    logging.error(f"ERROR: config for target-{target} not provided as file, env var or SSM parameter.")
+        target_config = get_ssm_parameter(ssm_parameter_name('target', target, project_config), project_config)
+        if target_config is None:
+            logging.error(f"ERROR: config for target-{target} not provided as file, env var or SSM parameter.")
+            raise ValueError(f"ERROR: config for target-{target} not found.")
+        target_config_json = json.loads(target_config)
+        clean_target_config = True
+        logging.info(f"config for target-{target} fetched successfully from SSM.")
 
     try:
         tap_schema = project_config['taps'].get(f"tap-{tap}")['schema']
@@ -122,7 +228,13 @@ def fetch_target_config(target, project_config, tap=None, s3_key_prefix=None):
     target_config_json['redshift_schema'] = tap_schema
     target_config_json['target_s3']['key_prefix'] = s3_key_prefix
 
-    with open(f"targets/target-{target_name_lower}/config.json",'w') as fh:
+    if output_path is None:
+        output_path = target_config_path
+    elif output_path != target_config_path:
+        # config written for a given tap is always temporary
+        clean_target_config = True
+
+    with open(output_path,'w') as fh:
         fh.write(json.dumps(target_config_json))
         logging.info(f"SUCCESS: target-{target_name_lower} parameters have been fetched.")
 
@@ -0,0 +1,142 @@
+import hashlib
+import logging
+import os
+import pickle
+from singer_aws.cache import cache_dir
+import sys
+import threading
+
+"""
+singer_project_config.yml is parsed and validated once, and the result is cached in memory
+and on disk (pickled, in the local singer-aws cache), keyed by path, mtime and size of the
+file. Subsequent loads in the same process or in subsequent runs (e.g. many short syncs
+launched by Airflow in the same container) don't parse YAML, nor even import yaml.
+"""
+
+PROJECT_CONFIG_PATH = "singer_project_config.yml"
+
+# bump when validation/normalization below changes, to invalidate configs cached on disk
+CONFIG_CACHE_VERSION = 6
+
+# properties of the project (and of taps/targets overriding them) which must be positive integers
+# (counts, sizes, intervals; to disable one, leave it out)
+INTEGER_PROPERTIES = [
+    'max_concurrency', 'state_retention', 'checkpoint_seconds', 'checkpoint_states', 'ssm_cache_ttl',
+    'fan_out_buffer_bytes', 'backfill_concurrency', 'meter_interval', 'spool_chunk_bytes',
+    'buffer_bytes', 'spill_bytes', 'compact_memory_bytes', 'compact_spill_bytes',
+    'monitor_interval', 'max_rss_bytes', 'max_cpu_seconds', 'timeout_seconds',
+    ]
+
+_lock = threading.Lock()
+_configs = {}
+
+
+def is_positive_integer(value):
+    return(isinstance(value, int) and not isinstance(value, bool) and value > 0)
+
+
+def validate_project_config(config, path=PROJECT_CONFIG_PATH):
+    """
+    Check structure of a parsed project config, returning list of errors. Empty entries
+    of taps and targets (e.g. `tap-example:` without properties) are replaced by {}.
+    """
+
+    if not isinstance(config, dict):
+        return([f"{path} must be a mapping of properties"])
+
+    errors = []
+    for section in ['taps', 'targets']:
+        entries = config.get(section)
+        if not isinstance(entries, dict):
+            errors.append(f"`{section}` must be a mapping of {section[:-1]} names to their properties")
+            continue
+        for name, properties in entries.items():
+            if properties is None:
+                entries[name] = properties = {}
+            if not isinstance(properties, dict):
+                errors.append(f"properties of {name} must be a mapping")
+                continue
+            if not name.startswith(f"{section[:-1]}-"):
+                errors.append(f"name of {name} must start with {section[:-1]}-")
+            for key in INTEGER_PROPERTIES:
+                if key in properties and not is_positive_integer(properties[key]):
+                    errors.append(f"`{key}` of {name} must be a positive integer")
+
+    for key in INTEGER_PROPERTIES:
+        if key in config and not is_positive_integer(config[key]):
+            errors.append(f"`{key}` must be a positive integer")
+
+    targets = config.get('targets') if isinstance(config.get('targets'), dict) else {}
+    for name, properties in (config.get('taps') if isinstance(config.get('taps'), dict) else {}).items():
+        if not isinstance(properties, dict):
+            continue
+        target = properties.get('target')
+        if target is not None and f"target-{target}" not in targets:
+            errors.append(f"target `{target}` of {name} is not defined in `targets`")
+        if properties.get('catalog_arg') not in [None, '--catalog', '--properties']:
+            errors.append(f"`catalog_arg` of {name} must be --catalog or --properties")
+
+    return(errors)
+
+
+def _cache_path(path):
+    name = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()[:16]
+    return(os.path.join(cache_dir('project_config'), f"{name}.pickle"))
+
+
+def _parse(path):
+    import yaml
+
+    with open(path, 'r') as stream:
+        try:
+            config = yaml.safe_load(stream)
+        except yaml.YAMLError as exc:
+            logging.error(f"ERROR occurred when reading {path} file: {exc}")
+            sys.exit(1)
+
+    errors = validate_project_config(config, path)
+    if errors:
+        logging.error(f"ERROR: {path} is not valid:\n" + "\n".join(f"    - {error}" for error in errors))
+        sys.exit(1)
+
+    return(config)
+
+
+def load_project_config(path=PROJECT_CONFIG_PATH):
+    """
+    Read singer project configuration file (parsed & validated once per version of the file).
+    Every call returns a separate copy, which callers are free to modify.
+    """
+
+    stat = os.stat(path)
+    key = (CONFIG_CACHE_VERSION, stat.st_mtime_ns, stat.st_size)
+    abspath = os.path.abspath(path)
+
+    with _lock:
+        cached = _configs.get(abspath)
+        if cached is not None and cached[0] == key:
+            return(pickle.loads(cached[1]))
+
+        data = None
+        cache_path = _cache_path(path)
+        try:
+            with open(cache_path, 'rb') as fh:
+                cached_key, cached_data = pickle.load(fh)
+            if cached_key == key:
+                data = cached_data
+        except Exception:
+            # missing or unreadable cache, e.g. written by another version of python
+            pass
+
+        if data is None:
+            data = pickle.dumps(_parse(path))
+            try:
+                path_tmp = f"{cache_path}.{os.getpid()}.tmp"
+                with open(path_tmp, 'wb') as fh:
+                    pickle.dump((key, data), fh)
+                os.replace(path_tmp, cache_path)
+            except OSError:
+                logging.warning(f"parsed {path} couldn't be cached on disk.")
+
+        _configs[abspath] = (key, data)
+        return(pickle.loads(data))
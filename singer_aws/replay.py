@@ -0,0 +1,90 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+from singer_aws.main import add_sync_arguments, run_pipeline
+from singer_aws.pipe import latest_spool, spool_path, spool_prefix
+from singer_aws.prep_config import prefetch_configs
+from singer_aws.project_config import load_project_config
+from singer_aws.sync import s3_client
+import sys
+
+"""
+Feeds messages of a tap saved by `singer-aws-sync --spool` into a target, without
+running the tap again (e.g. after the target failed). State emitted by the target
+is uploaded to S3 just like after a regular sync.
+"""
+
+def download_spool(tap, project_config, run_id=None):
+    """
+    Download a spool of a tap (the most recent one, unless run_id is passed) from S3
+    data_bucket into spool/ directory. Returns path of the downloaded spool.
+    """
+
+    s3 = s3_client(project_config, project_config.get('redshift_aws_profile'))
+    bucket = project_config.get('data_bucket')
+    prefix = spool_prefix(tap)
+
+    if run_id is None:
+        run_ids = []
+        paginator = s3.get_paginator("list_objects")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+            run_ids += [common['Prefix'][len(prefix):].strip('/') for common in page.get('CommonPrefixes', [])]
+        run_ids = [run_id for run_id in run_ids if run_id.isdigit()]
+        if not run_ids:
+            raise ValueError(f"ERROR: no spool of {tap} found in s3://{bucket}/{prefix}.")
+        run_id = max(run_ids, key=int)
+
+    path = os.path.join(spool_path, tap, run_id)
+    os.makedirs(path, exist_ok=True)
+
+    manifest_path = os.path.join(path, "manifest.json")
+    s3.download_file(bucket, f"{prefix}{run_id}/manifest.json", manifest_path)
+    with open(manifest_path) as fh:
+        parts = json.load(fh)['parts']
+    for name in parts:
+        s3.download_file(bucket, f"{prefix}{run_id}/{name}", os.path.join(path, name))
+
+    logging.info(f"SUCCESS: spool of {tap} downloaded from s3://{bucket}/{prefix}{run_id}/.")
+    return(path)
+
+
+def main():
+
+    logging.basicConfig(level = logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Replay spooled messages of a Singer Tap into a Singer Target.')
+    parser.add_argument('--tap', help='Name of Singer Tap whose messages are replayed.', required=True)
+    parser.add_argument('--target', help='Name of Singer Tap target to replay into.', required=True)
+    parser.add_argument('--run-id', help='Run id of the spool to replay (the most recent spool by default).')
+    parser.add_argument('--from-s3', action='store_true', help='If passed, spool is downloaded from S3 \
+        data_bucket instead of being read from local spool/ directory.')
+    add_sync_arguments(parser)
+    args = parser.parse_args()
+    # messages being replayed are already spooled
+    args.spool = False
+
+    project_config = load_project_config()
+    tap = f"tap-{args.tap}"
+
+    if args.from_s3:
+        replay_path = download_spool(tap, project_config, args.run_id)
+    elif args.run_id is not None:
+        replay_path = os.path.join(spool_path, tap, args.run_id)
+    else:
+        replay_path = latest_spool(tap)
+
+    if replay_path is None or not os.path.exists(os.path.join(replay_path, "manifest.json")):
+        logging.error(f"ERROR: no spool of {tap} found in {os.path.join(spool_path, tap)}.")
+        sys.exit(1)
+
+    prefetch_configs([], [args.target], project_config)
+    run_pipeline(args.tap, args.target, project_config, args, replay_path=replay_path)
+    logging.info(f"SUCCESS: spool {replay_path} replayed into target-{args.target}.")
+
+    if not args.spool_keep:
+        shutil.rmtree(replay_path, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
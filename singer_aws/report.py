@@ -0,0 +1,183 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+"""
+Run report of singer-aws-sync: wall-clock time spent in every phase of the run (reading
+project config, SSM, STS, fetching state from S3, tap & target processes, uploading state...),
+written as JSON to reports/<tap>-<started_at>.json and optionally uploaded to S3 next to
+states of the tap (singer/<tap>/reports/).
+
+Phases are timed with `with phase(name):` wherever they happen; timing is a no-op unless a
+report has been started (see start), so code shared with other commands is not affected.
+With profiling enabled, Python code of the main thread is profiled with cProfile, and
+the report lists functions with the highest cumulative time (full stats are saved
+next to the report, to be inspected with pstats or snakeviz).
+"""
+
+singer_home = os.getcwd()
+reports_path = os.path.join(singer_home, 'reports')
+
+# number of functions (by cumulative time) listed in the report of a profiled run
+PROFILE_TOP_FUNCTIONS = 30
+
+_report = None
+
+
+class RunReport:
+    """
+    Phases (name, start offset & duration in seconds) and other facts of a single run.
+    """
+
+    def __init__(self, tap, target, profile=False):
+        self.tap = tap
+        self.target = target
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.monotonic()
+        self.phases = []
+        self.facts = {}
+        self.lock = threading.Lock()
+        self.profiler = None
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def record(self, name, start, seconds):
+        with self.lock:
+            self.phases.append({
+                "name": name,
+                "start_seconds": round(start - self.started, 4),
+                "seconds": round(seconds, 4),
+            })
+
+    def finish(self, error=None):
+        """
+        Stop profiling and return the report as a dict.
+        """
+
+        if self.profiler is not None:
+            self.profiler.disable()
+
+        totals = {}
+        for recorded in self.phases:
+            total = totals.setdefault(recorded["name"], {"seconds": 0.0, "count": 0})
+            total["seconds"] = round(total["seconds"] + recorded["seconds"], 4)
+            total["count"] += 1
+
+        report = {
+            "tap": self.tap,
+            "target": self.target,
+            "started_at": self.started_at.isoformat(),
+            "elapsed_seconds": round(time.monotonic() - self.started, 4),
+            "status": "success" if error is None else "failed",
+            "error": None if error is None else repr(error),
+            "phases": sorted(self.phases, key=lambda recorded: recorded["start_seconds"]),
+            "totals": totals,
+        }
+        report.update(self.facts)
+        if self.profiler is not None:
+            report["profile"] = self.top_functions()
+        return(report)
+
+    def top_functions(self):
+        import pstats
+
+        stats = pstats.Stats(self.profiler, stream=io.StringIO())
+        stats.sort_stats("cumulative")
+        functions = []
+        for (filename, line, function) in stats.fcn_list[:PROFILE_TOP_FUNCTIONS]:
+            calls, _, own_seconds, cumulative_seconds, _ = stats.stats[(filename, line, function)]
+            functions.append({
+                "function": f"{filename}:{line}({function})",
+                "calls": calls,
+                "own_seconds": round(own_seconds, 4),
+                "cumulative_seconds": round(cumulative_seconds, 4),
+            })
+        return(functions)
+
+    def name(self):
+        return(f"{self.tap}-{self.started_at.strftime('%Y%m%dT%H%M%S')}{self.started_at.microsecond // 1000:03d}Z")
+
+    def write(self, report):
+        """
+        Write the report (and profiler stats, if profiled) to reports/. Returns path of the report.
+        """
+
+        os.makedirs(reports_path, exist_ok=True)
+        path = os.path.join(reports_path, f"{self.name()}.json")
+        with open(path, 'w') as fh:
+            json.dump(report, fh, indent=2)
+        if self.profiler is not None:
+            self.profiler.dump_stats(os.path.join(reports_path, f"{self.name()}.prof"))
+        logging.info(f"SUCCESS: run report of {self.tap} written to {path}.")
+        return(path)
+
+
+def start(tap, target, profile=False):
+    """
+    Start the report of the current run, returning it.
+    """
+
+    global _report
+    _report = RunReport(tap, target, profile)
+    return(_report)
+
+
+def stop():
+    """
+    Stop timing phases of the current run.
+    """
+
+    global _report
+    _report = None
+
+
+@contextmanager
+def phase(name):
+    """
+    Time a phase of the current run, if a report has been started.
+    """
+
+    report = _report
+    if report is None:
+        yield
+        return
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        report.record(name, start_time, time.monotonic() - start_time)
+
+
+def record(name, start_time):
+    """
+    Record a phase of the current run which started at start_time (time.monotonic()) and ends now.
+    """
+
+    report = _report
+    if report is not None:
+        report.record(name, start_time, time.monotonic() - start_time)
+
+
+def note(key, value):
+    """
+    Add a fact (e.g. relay wait times) to the report of the current run, if started.
+    """
+
+    report = _report
+    if report is not None:
+        with report.lock:
+            report.facts[key] = value
+
+
+def report_prefix(tap):
+    """
+    S3 prefix under which run reports of a given tap are uploaded, next to its states.
+    """
+    return(f"singer/{tap}/reports/")
@@ -1,14 +1,14 @@
-import boto3
+import asyncio
+import glob
 import json
 import logging
 import os
-import random
-import shutil
-import string
-from subprocess import PIPE, Popen
+from singer_aws import aws, engine
+from singer_aws.catalog import pruned_catalog_path
+from singer_aws.pipe import StateMergeStage
+from singer_aws.report import note, phase, record
 import sys
 import time
-import yaml
 
 logging.basicConfig(level = logging.INFO)
 
@@ -21,53 +21,22 @@ def boto_resource(iam_role_arn):
     Starts a boto resource from a IAM role
     """
 
-    sts_client = boto3.client("sts")
-
-    uid = "".join(random.choice(string.hexdigits) for n in range(8))
-    response = sts_client.assume_role(RoleArn=iam_role_arn, RoleSessionName=f"singer_{uid}")
-
-    credentials = response["Credentials"]
-    params = {
-        "aws_access_key_id": credentials["AccessKeyId"],
-        "aws_secret_access_key": credentials["SecretAccessKey"],
-        "aws_session_token": credentials["SessionToken"],
-    }
-
-    session = boto3.Session(**params)
-    resource = session.resource('s3')
-
-    return(resource)
+    return(aws.resource('s3', iam_role_arn=iam_role_arn))
 
 
 def boto_client(iam_role_arn):
     """
-    Starts a boto resource from a IAM role
+    Starts a boto client from a IAM role
     """
 
-    sts_client = boto3.client("sts")
-
-    uid = "".join(random.choice(string.hexdigits) for n in range(8))
-    response = sts_client.assume_role(RoleArn=iam_role_arn, RoleSessionName=f"singer_{uid}")
-
-    credentials = response["Credentials"]
-    params = {
-        "aws_access_key_id": credentials["AccessKeyId"],
-        "aws_secret_access_key": credentials["SecretAccessKey"],
-        "aws_session_token": credentials["SessionToken"],
-    }
-
-    session = boto3.Session(**params)
-    client = session.client('s3')
-
-    return(client)
+    return(aws.client('s3', iam_role_arn=iam_role_arn))
 
 
 def s3_client(project_config, aws_profile=None):
     """Create S3 client, sourced from AWS_PROFILE when run locally or from
-    default session when run by Airflow."""
+    default session when run by Airflow. The client is shared by the whole run."""
     if aws_profile is not None:
-        session = boto3.Session(profile_name=aws_profile)
-        client = session.client('s3')
+        client = aws.client('s3', aws_profile=aws_profile)
     else:
         client = boto_client(project_config.get('redshift_iam_role'))
     return(client)
@@ -77,160 +46,561 @@ def s3_resource(project_config, aws_profile=None):
     """Create S3 resource, sourced from AWS_PROFILE when run locally or from
     default session when run by Airflow."""
     if aws_profile is not None:
-        session = boto3.Session(profile_name=aws_profile)
-        resource = session.resource('s3')
+        resource = aws.resource('s3', aws_profile=aws_profile)
     else:
         resource = boto_resource(project_config.get('redshift_iam_role'))
     return(resource)
 
 
+def state_prefix(tap):
+    """
+    S3 prefix under which all state files of a given tap are stored. When a tap fans out
+    to several targets, they all share this state (see sync).
+    """
+    return(f"singer/{tap}/states/")
+
+
+def latest_state_key(tap):
+    """
+    S3 key of the manifest pointing at (and holding) the last state file of a given tap.
+    """
+    return(f"{state_prefix(tap)}LATEST")
+
+
+def state_file_name(tap, target=None, part=None):
+    """
+    Name of a local state file (in states_in/ or states_out/) of a given tap. target names
+    additional targets of a tap, whose states are kept apart locally.
+    part distinguishes state files of several tap processes of a single sync (see sync).
+    """
+    name = tap
+    if part is not None:
+        name += f"-part-{part}"
+    if target is not None:
+        name += f"-target-{target}"
+    return(f"{name}-state.json")
+
+
+def merge_states(states):
+    """
+    Merge states emitted by several tap processes of a single sync, e.g. processes
+    replicating disjoint sets of streams or consecutive time windows. Dicts (such
+    as `bookmarks`) are merged recursively, values of later states win.
+    """
+
+    merged = {}
+    for state in states:
+        for key, value in state.items():
+            if isinstance(value, dict) and isinstance(merged.get(key), dict):
+                merged[key] = merge_states([merged[key], value])
+            else:
+                merged[key] = value
+
+    # a merged state describes finished processes, nothing is being synced anymore
+    if 'currently_syncing' in merged:
+        merged['currently_syncing'] = None
+
+    return(merged)
+
+
 def get_state_filename(tap, project_config, bucket, aws_profile=None):
     """
-    Get last Singer state file name for a given tap name and environment.
+    Get last Singer state file name for a given tap name and environment, by listing
+    all state files of the tap. Used only as a fallback when the LATEST manifest
+    doesn't exist yet (states uploaded by older versions of singer-aws).
     """
 
     s3 = s3_client(project_config, aws_profile)
-    prefix = f"singer/{tap}/states/"
+    prefix = state_prefix(tap)
+    skip_keys = [prefix, latest_state_key(tap)]
 
     last_state = ''
-    get_last_modified = lambda obj: int(obj['LastModified'].strftime('%s'))
+    last_modified = None
     paginator = s3.get_paginator("list_objects")
     page_iterator = paginator.paginate(Bucket=bucket, Prefix=prefix)
     for page in page_iterator:
-        if "Contents" in page:
-            last_object = [obj['Key'] for obj in sorted(page["Contents"], key=get_last_modified)][-1]
-            last_state = last_object if last_object != prefix else ''
+        for obj in page.get("Contents", []):
+            if obj['Key'] in skip_keys:
+                continue
+            # keys are prefixed with upload time in ms, so they break LastModified ties
+            if last_modified is None or (obj['LastModified'], obj['Key']) > (last_modified, last_state):
+                last_modified = obj['LastModified']
+                last_state = obj['Key']
 
     return(last_state)
 
 
+def get_latest_state(tap, project_config, bucket, aws_profile=None):
+    """
+    Read the LATEST state manifest of a given tap with a single GET request.
+    Returns None if the manifest doesn't exist.
+    """
+
+    s3 = s3_client(project_config, aws_profile)
+    try:
+        response = s3.get_object(Bucket=bucket, Key=latest_state_key(tap))
+    except s3.exceptions.NoSuchKey:
+        return(None)
+
+    return(json.loads(response['Body'].read()))
+
+
+def put_latest_state(tap, project_config, bucket, state_filename, state, aws_profile=None):
+    """
+    Point the LATEST state manifest of a given tap at state_filename. The manifest
+    also holds the state itself, so that it can be fetched without a 2nd request.
+    """
+
+    s3 = s3_client(project_config, aws_profile)
+    manifest = {
+        "key": state_filename,
+        "updated_at": int(time.time()*1000),
+        "state": json.loads(state)
+        }
+    s3.put_object(Bucket=bucket, Key=latest_state_key(tap), Body=json.dumps(manifest).encode())
+
+
 def get_state(tap, project_config, bucket, aws_profile=None):
     """
     Download last Singer state file for a given tap name and environment.
+    Returns False if no state file exists for the tap yet (very first run), True otherwise.
     """
-    s3 = s3_resource(project_config, aws_profile)
-    state_filename = get_state_filename(tap, project_config, bucket, aws_profile)
-    try:
-        os.makedirs(states_in_path)
-    except FileExistsError:
-        pass
+
+    # imported here, as boto3 is imported only once it's needed (see singer_aws.aws)
+    from botocore.exceptions import BotoCoreError, ClientError
 
     try:
-        s3.Bucket(bucket).download_file(state_filename, f"{states_in_path}/{tap}-state.json")
-        logging.info(f"SUCCESS: Last state for {tap} has been fetched from s3://{bucket}/{state_filename}.")
-    except:
-        logging.error(f"ERROR: Last state for {tap} wasn't fetched from S3.")
-        sys.exit(0)
+        manifest = get_latest_state(tap, project_config, bucket, aws_profile)
+        if manifest is not None:
+            state_filename = manifest['key']
+            state = json.dumps(manifest['state'])
+        else:
+            # migration path: find last state by listing, then create the manifest
+            with phase("s3_list_states"):
+                state_filename = get_state_filename(tap, project_config, bucket, aws_profile)
+            if state_filename == '':
+                logging.info(f"no previous state found for {tap} in s3://{bucket}/{state_prefix(tap)}.")
+                return(False)
+            s3 = s3_client(project_config, aws_profile)
+            state = s3.get_object(Bucket=bucket, Key=state_filename)['Body'].read().decode()
+            json.loads(state)
+    except (BotoCoreError, ClientError, KeyError, ValueError) as exc:
+        # ValueError: state or manifest isn't valid JSON, KeyError: manifest is missing its key or state
+        logging.error(f"ERROR: Last state for {tap} wasn't fetched from S3: {exc!r}")
+        sys.exit(1)
+
+    if manifest is None:
+        try:
+            put_latest_state(tap, project_config, bucket, state_filename, state, aws_profile)
+        except (BotoCoreError, ClientError) as exc:
+            # the state is listed again next time
+            logging.warning(f"LATEST state manifest of {tap} wasn't written: {exc!r}")
 
+    write_state(f"{states_in_path}/{tap}-state.json", state)
+    logging.info(f"SUCCESS: Last state for {tap} has been fetched from s3://{bucket}/{state_filename}.")
+    return(True)
 
-def send_state(tap, project_config, bucket, aws_profile=None):
+
+def send_state(tap, project_config, bucket, aws_profile=None, state=None):
     """
-    Upload last Singer state file to S3, for a given tap name and environment.
+    Upload last Singer state file to S3, for a given tap name and environment,
+    and point the LATEST state manifest at it.
+    If state (a state line) is passed, it is uploaded instead of the state file.
     """
-    s3 = s3_resource(project_config, aws_profile)
+    s3 = s3_client(project_config, aws_profile)
     # get current timestamp in miliseconds to construct name of uploaded file
     t = str(int(time.time()*1000))
-    state_filename = f"singer/{tap}/states/{t}-{tap}-state.json"
+    state_filename = f"{state_prefix(tap)}{t}-{tap}-state.json"
+
+    if state is None:
+        with open(f"{states_out_path}/{state_file_name(tap)}") as state_file:
+            state = state_file.read()
 
     try:
-        s3.Bucket(bucket).upload_file(f"{states_out_path}/{tap}-state.json", state_filename)
+        with phase("send_state"):
+            s3.put_object(Bucket=bucket, Key=state_filename, Body=state.encode())
+            put_latest_state(tap, project_config, bucket, state_filename, state, aws_profile)
         logging.info(f"SUCCESS: Last state for {tap} has been uploaded to s3://{bucket}/{state_filename}.")
     except:
         logging.error(f"ERROR: Last state for {tap} wasn't uploaded to S3.")
         sys.exit(0)
 
 
-def sync(tap, target, project_config, bucket, ignore_state=False, aws_profile=None):
+def prune_states(tap, project_config, bucket, keep, aws_profile=None):
+    """
+    Delete all but `keep` most recent state files of a given tap from S3.
+    The LATEST manifest is never deleted.
+    """
+
+    s3 = s3_client(project_config, aws_profile)
+    prefix = state_prefix(tap)
+    skip_keys = [prefix, latest_state_key(tap)]
+
+    objects = []
+    paginator = s3.get_paginator("list_objects")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        objects += [(obj['LastModified'], obj['Key']) for obj in page.get("Contents", []) if obj['Key'] not in skip_keys]
+
+    expired = [key for _, key in sorted(objects, reverse=True)[keep:]]
+
+    # delete_objects accepts up to 1000 keys per request
+    for i in range(0, len(expired), 1000):
+        batch = [{'Key': key} for key in expired[i:i+1000]]
+        s3.delete_objects(Bucket=bucket, Delete={'Objects': batch, 'Quiet': True})
+
+    if expired:
+        logging.info(f"SUCCESS: {len(expired)} old state files of {tap} pruned from s3://{bucket}/{prefix}.")
+
+
+class StateCheckpointer:
     """
-    Invoke Singer Tap shell command.
+    Uploads the most recent state emitted by a Singer Target to S3 from a coroutine of
+    the sync's event loop while the sync is still running: every `seconds` seconds or
+    every `states` state messages, whichever comes first. Uploads run in a thread, so
+    they never block the pipeline. States that have not changed since the last
+    checkpoint are not uploaded again.
+    """
+
+    def __init__(self, upload, seconds=None, states=None):
+        self.upload = upload
+        self.seconds = seconds
+        self.states = states
+        self.latest = None
+        self.uploaded = None
+        self.pending = 0
+        self.stopped = False
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    def offer(self, state):
+        """
+        Register a new state emitted by the target. Called for every state line read from
+        the target, so it only swaps a reference and never waits for S3.
+        """
+        self.latest = state
+        self.pending += 1
+        if self.states is not None and self.pending >= self.states:
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.seconds)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if self.stopped:
+                return
+            await self.checkpoint()
+
+    async def checkpoint(self):
+        state = self.latest
+        self.pending = 0
+        if state is None or state == self.uploaded:
+            return
+        try:
+            await asyncio.to_thread(self.upload, state)
+        except (Exception, SystemExit):
+            # a failed checkpoint must not break the sync, next one will retry
+            logging.warning("checkpoint of state to S3 failed, will retry on next checkpoint.")
+            return
+        self.uploaded = state
+
+    async def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+        await self.task
+
+
+def sync(*args, **kwargs):
+    """
+    Run a sync (see run_sync) on an event loop of its own.
+    """
+    return(asyncio.run(run_sync(*args, **kwargs)))
+
+
+async def run_sync(tap, target, project_config, bucket, ignore_state=False, aws_profile=None,
+                   checkpoint_seconds=None, checkpoint_states=None, target_config_path=None, stages=None,
+                   replay_path=None, extra_targets=(), buffer_bytes=None, tap_config_path=None, part=None,
+                   send_states=True, partitions=None, base_state=None, spill_bytes=None, buffered=False,
+                   prune_catalog=None, timeout=None):
+    """
+    Invoke Singer Tap shell command (run as a pipeline of singer_aws.engine). Calls to S3 run
+    in threads, so that many syncs can run on a single event loop (see singer_aws.engine.run_many).
+    If checkpoint_seconds or checkpoint_states is passed, newest state emitted by the target
+    is also uploaded to S3 periodically during the sync (see StateCheckpointer).
+    target_config_path defaults to targets/target-name/config.json.
+    If stages (see singer_aws.pipe) are passed, messages of the tap are relayed through
+    them to the target, instead of connecting the tap to the target directly.
+    If replay_path (a spool directory, see singer_aws.pipe.SpoolStage) is passed, messages
+    saved in it are fed into the target instead of running the tap.
+    If extra_targets are passed, messages of the tap are fanned out to all targets, each
+    of them fed from its own buffer of up to buffer_bytes, so that a slow target holds the
+    others back only once its buffer is full. All targets share the state of the tap: the state
+    emitted by the first target is uploaded, only if every target succeeded (so that none of them
+    resumes past records it didn't load); it's not checkpointed during the sync.
+    If buffered is True, a single target is fed from such a buffer too, so that the tap
+    keeps going while the target is busy. If spill_bytes is passed, messages exceeding
+    the buffer are spilled to disk, up to spill_bytes per target (see singer_aws.engine.TargetFeed).
+    tap_config_path defaults to taps/tap-name/config.json. part names a tap process when
+    a sync runs several of them at once (see singer_aws.backfill). If send_states is False,
+    states are not uploaded to S3 (nor checkpointed).
+    If partitions (see singer_aws.partition) are passed, state is not fetched from S3; instead
+    a tap process is started for every partition, with its own catalog and state, and their
+    messages are merged into the target(s), with states merged on top of base_state.
+    If prune_catalog is True (or, when it's None, if `prune_catalog` is set for the tap or the
+    project in singer_project_config.yml), the tap is handed a catalog pruned to what it replicates
+    (see singer_aws.catalog.prune_catalog) instead of the full one.
+    If timeout (seconds; when it's None, `timeout_seconds` of the tap or the project) is exceeded,
+    or a tap or target exceeds its resource limits (see singer_aws.monitor), the tap is stopped,
+    state loaded so far is saved and the sync fails.
+    Returns last state emitted by each target (by target name), None if a target emitted none.
     """
 
     tap = f"tap-{tap}"
 
     # make temporary directory for state files before they're uploaded to S3
-    try:
-        os.makedirs(states_out_path)
-    except FileExistsError:
-        pass
+    os.makedirs(states_out_path, exist_ok=True)
 
     catalog_arg = project_config['taps'].get(tap).get('catalog_arg')
-    if catalog_arg is not None:
-        catalog_arg = [catalog_arg, os.path.join(singer_home, f"taps/{tap}/catalog.json")]
-
-    # construct state argument for tap execution, depending on existence of state file in S3
-    # and presence/absence of --ignore-state flag passed to the command
-    if ignore_state is True:
-        # if an --ignore-state flag is passed to the executed command
-        state_in_arg = None
-    elif get_state_filename(tap, project_config, bucket, aws_profile) == '':
-        # very first run of a tap, no previous state file found in S3
-        state_in_arg = None
-    else:
-        # 2nd, 3rd, or next run of a tap, requiring to get state file from S3
-        state_in_arg = ["--state", os.path.join(singer_home, f"states_in/{tap}-state.json")]
-        # also download state file to feed to the tap
-        get_state(tap, project_config, bucket, aws_profile)
 
-    tap_module = project_config['taps'].get(tap).get('module') or tap
-    target_module = project_config['targets'].get(f"target-{target}").get('module') or target
-
-    cmd_tap = [
-        os.path.join(singer_home, f"venv/{tap}/bin/{tap_module}"),
-        "--config",
-        os.path.join(singer_home, f"taps/{tap}/config.json")
-        ]
-
-    if catalog_arg is not None:
-        cmd_tap += catalog_arg
-    if state_in_arg is not None:
-        cmd_tap += state_in_arg
-
-    cmd_target = [
-        os.path.join(singer_home, f"venv/target-{target}/bin/target-{target_module}"),
-        "--config",
-        os.path.join(singer_home, f"targets/target-{target}/config.json")
-        ]
-
-    path_state = os.path.join(singer_home, f"states_out/{tap}-state.json")
-
-    cmd_to_print = cmd_tap + ['|'] + cmd_target + [">"] + [path_state]
-
-    logging.info(f'RUNNING: {tap} shell command:\n{" ".join(cmd_to_print)}')
-    proc_tap = Popen(cmd_tap, stdout=PIPE)
-    proc_target = Popen(cmd_target, stdin=proc_tap.stdout, stdout=PIPE)
-
-    out, err = proc_target.communicate()
-
-    # write only last line of stdout into state file
-    with open(path_state, "w") as state_file:
-        if out not in [None, '']:
-            # handle cases in which no state has been emitted -- e.g. if singer sync
-            # only covered streams that do not emit state
-            state_file.write(out.decode().splitlines()[-1])
-            # send state after sync to S3
+    if partitions is None:
+        # construct state argument for tap execution, depending on existence of state file in S3
+        # and presence/absence of --ignore-state flag passed to the command
+        if ignore_state is True or replay_path is not None:
+            # if an --ignore-state flag is passed to the executed command (or tap is not run at all)
+            state_in = None
         else:
-            # there is no state emitted
-            pass
+            with phase("get_state"):
+                fetched = await asyncio.to_thread(get_state, tap, project_config, bucket, aws_profile)
+            if fetched:
+                # 2nd, 3rd, or next run of a tap, state file has been downloaded from S3 to feed to the tap
+                state_in = f"states_in/{tap}-state.json"
+            else:
+                # very first run of a tap, no previous state file found in S3
+                state_in = None
+        partitions = [{"catalog": f"taps/{tap}/catalog.json", "state": state_in}]
+
+    if prune_catalog is None:
+        prune_catalog = (project_config['taps'].get(tap) or {}).get('prune_catalog', project_config.get('prune_catalog'))
+    if prune_catalog and catalog_arg is not None and replay_path is None:
+        with phase("prune_catalog"):
+            partitions = [
+                dict(partition, catalog=pruned_catalog_path(os.path.join(singer_home, partition["catalog"])))
+                for partition in partitions
+                ]
 
-    if out not in [None, '']:
-        send_state(tap, project_config, bucket, aws_profile)
+    tap_module = project_config['taps'].get(tap).get('module') or tap
+
+    cmd_taps = []
+    for partition in partitions:
+        cmd_tap = [
+            os.path.join(singer_home, f"venv/{tap}/bin/{tap_module}"),
+            "--config",
+            os.path.join(singer_home, tap_config_path or f"taps/{tap}/config.json")
+            ]
+        if catalog_arg is not None:
+            cmd_tap += [catalog_arg, os.path.join(singer_home, partition["catalog"])]
+        if partition["state"] is not None:
+            cmd_tap += ["--state", os.path.join(singer_home, partition["state"])]
+        cmd_taps.append(cmd_tap)
+
+    # state of the first target is the state of the tap, shared by all its targets
+    runs = []
+    for i, name in enumerate([target] + list(extra_targets)):
+        target_module = project_config['targets'].get(f"target-{name}").get('module') or name
+        config_path = target_config_path if i == 0 and target_config_path else f"targets/target-{name}/config.json"
+        runs.append({
+            "name": name,
+            "cmd": [
+                os.path.join(singer_home, f"venv/target-{name}/bin/target-{target_module}"),
+                "--config",
+                os.path.join(singer_home, config_path)
+                ],
+            "path_state": os.path.join(states_out_path, state_file_name(tap, None if i == 0 else name, part)),
+            })
+
+    cmd_targets = [" ".join(run["cmd"] + [">", run["path_state"]]) for run in runs]
+    if replay_path is not None:
+        cmd_source = " ".join(['zcat', os.path.join(replay_path, 'part-*.jsonl.gz')])
+    elif len(cmd_taps) > 1:
+        cmd_source = f"({' & '.join(' '.join(cmd_tap) for cmd_tap in cmd_taps)} & wait)"
+    else:
+        cmd_source = " ".join(cmd_taps[0])
+    if len(runs) > 1:
+        cmd_to_print = f"{cmd_source} | tee >({') >('.join(cmd_targets[1:])}) | {cmd_targets[0]}"
     else:
-        # there is no state emitted == no state to be sent to S3
-        pass
+        cmd_to_print = f"{cmd_source} | {cmd_targets[0]}"
 
-    if proc_target.returncode != 0:
-        raise ValueError(f"ERROR: {tap} Singer Tap shell command failed:\n{err.decode()}")
+    if part is not None:
+        logging.info(f'RUNNING: {tap} ({part}) shell command:\n{cmd_to_print}')
+    else:
+        logging.info(f'RUNNING: {tap} shell command:\n{cmd_to_print}')
+
+    tap_names = [tap] if len(cmd_taps) == 1 else [f"{tap}-{partition.get('name', i)}" for i, partition in enumerate(partitions)]
+    limits = {name: project_config['taps'].get(tap) or {} for name in tap_names}
+    if len(runs) > 1 and (checkpoint_seconds or checkpoint_states):
+        logging.warning(f"states of {tap} are not checkpointed when it's loaded into several targets, "
+                        "they are uploaded once every target succeeds.")
+        checkpoint_seconds = checkpoint_states = None
+
+    targets = []
+    for run in runs:
+        run["last_state"] = None
+        run["checkpointer"] = None
+        if send_states and (checkpoint_seconds or checkpoint_states):
+            run["checkpointer"] = StateCheckpointer(
+                lambda state: send_state(tap, project_config, bucket, aws_profile, state=state),
+                seconds=checkpoint_seconds,
+                states=checkpoint_states
+                )
+            run["checkpointer"].start()
+
+        # keep only the last state line emitted by the target (written to path_state)
+        def on_line(line, run=run):
+            checkpointer = run["checkpointer"]
+            state = read_state(line, run["path_state"], on_state=checkpointer and checkpointer.offer)
+            if state is not None:
+                run["last_state"] = state
+
+        targets.append({"name": f"target-{run['name']}", "cmd": run["cmd"], "on_line": on_line})
+        limits[f"target-{run['name']}"] = project_config['targets'].get(f"target-{run['name']}") or {}
+
+    if len(cmd_taps) > 1:
+        # every tap emits bookmarks of its own streams only, the target gets all of them
+        stages = [StateMergeStage(tap, base_state)] + list(stages or [])
+
+    if timeout is None:
+        timeout = (project_config['taps'].get(tap) or {}).get('timeout_seconds', project_config.get('timeout_seconds'))
+
+    pipeline = engine.Pipeline(
+        [] if replay_path is not None else list(zip(tap_names, cmd_taps)), targets, stages or [], replay_path,
+        buffer_bytes, spill_bytes, buffered, timeout, limits, project_config.get('monitor_interval'))
+    pipeline_started = time.monotonic()
+    try:
+        await pipeline.run()
+    finally:
+        for run in runs:
+            if run["checkpointer"] is not None:
+                await run["checkpointer"].stop()
+    for run in runs:
+        run["returncode"] = pipeline.returncodes[f"target-{run['name']}"]
+        run["stderr_tail"] = pipeline.stderr_tails.get(f"target-{run['name']}") or []
+    record("tap_target" if part is None else f"tap_target:{part}", pipeline_started)
+    if pipeline.relayed:
+        note("relay" if part is None else f"relay:{part}", {
+            "tap_wait_seconds": round(pipeline.read_seconds, 4),
+            "target_wait_seconds": round(pipeline.write_seconds, 4),
+            "targets": pipeline.feed_stats(),
+            })
+    if pipeline.monitor is not None:
+        note("resources" if part is None else f"resources:{part}", pipeline.monitor.summary())
+
+    failed = [run for run in runs if run["returncode"] != 0]
+    if failed and len(runs) > 1:
+        # all targets resume from the same state, which mustn't advance past records a failed target didn't load
+        logging.error(f"ERROR: not all targets of {tap} succeeded, their state is not uploaded.")
+        send_states = False
+
+    try:
+        state_retention = project_config.get('state_retention')
+        # targets which all succeeded were fed the same messages, so the first one's state is theirs too
+        for run in runs[:1]:
+            last_state = run["last_state"]
+            checkpointer = run["checkpointer"]
+
+            if not send_states:
+                pass
+            elif last_state is None:
+                # there is no state emitted == no state to be sent to S3, e.g. if singer sync
+                # only covered streams that do not emit state
+                pass
+            elif checkpointer is not None and last_state == checkpointer.uploaded:
+                logging.info(f"last state for {tap} has not changed since the last checkpoint, skipping upload.")
+            else:
+                # send state after sync to S3
+                await asyncio.to_thread(send_state, tap, project_config, bucket, aws_profile)
+
+            if send_states and last_state is not None and state_retention:
+                with phase("prune_states"):
+                    await asyncio.to_thread(prune_states, tap, project_config, bucket, state_retention, aws_profile)
+    finally:
+        # after states are uploaded, so that e.g. a failed upload of a spool doesn't lose them,
+        # but also if that fails, so that the spool can be replayed
+        for stage in stages or []:
+            stage.finish(pipeline.tap_returncode, max(run["returncode"] for run in runs))
+
+    if failed:
+        err = "\n".join(
+            f"target-{run['name']}:\n" + b"".join(run["stderr_tail"]).decode(errors="replace") for run in failed
+            )
+        raise ValueError(f"ERROR: {tap} Singer Tap shell command failed:\n{err}")
+    elif pipeline.stopped is not None:
+        # state loaded so far has been saved, but the tap didn't finish
+        raise ValueError(f"ERROR: {tap} was stopped early: {pipeline.stopped}.")
     else:
         logging.info(f"SUCCESS: {tap} Singer Tap shell command succeeded.")
 
+    return({run["name"]: run["last_state"] for run in runs})
+
+
+def write_state(path_state, state_line):
+    """
+    Atomically (over)write a state file with a single state line.
+    """
+
+    os.makedirs(os.path.dirname(path_state), exist_ok=True)
+    path_tmp = f"{path_state}.tmp"
+    with open(path_tmp, "w") as state_file:
+        state_file.write(state_line)
+    os.replace(path_tmp, path_state)
+
+
+def read_state(line, path_state, on_state=None):
+    """
+    Persist a line of stdout of a Singer Target to path_state as soon as it is emitted,
+    if it's a valid state, and pass it to on_state callback, if provided. Returns the
+    state line, or None if the line is not a state.
+    """
+
+    line = line.strip()
+    if not line:
+        return(None)
+    try:
+        state = json.loads(line)
+    except ValueError:
+        logging.warning(f"skipping line emitted by target which is not a valid state: {line.decode(errors='replace')[:200]}")
+        return(None)
+    if not isinstance(state, dict):
+        return(None)
+
+    state_line = line.decode()
+    write_state(path_state, state_line)
+    if on_state is not None:
+        on_state(state_line)
+    return(state_line)
+
 
 def cleanup_tap(tap, clean_tap_config=True):
     """
     Cleanup temporary folders and sensitive config files after Singer Tap execution.
+    Only state files of the given tap are removed, while states_in/ and states_out/ are
+    kept, so that other taps syncing concurrently (which share them) are not affected.
     """
 
-    shutil.rmtree(states_in_path, ignore_errors=True)
-    shutil.rmtree(states_out_path, ignore_errors=True)
+    for path in [states_in_path, states_out_path]:
+        # state files of the tap, incl. those of its additional targets (see state_file_name)
+        state_paths = [os.path.join(path, f"tap-{tap}-state.json")]
+        state_paths += glob.glob(os.path.join(path, f"tap-{tap}-target-*-state.json"))
+        state_paths += glob.glob(os.path.join(path, f"tap-{tap}-part-*-state.json"))
+        for state_path in state_paths:
+            try:
+                os.remove(state_path)
+            except OSError:
+                pass
 
     if clean_tap_config is True:
         try:
@@ -241,17 +611,15 @@ def cleanup_tap(tap, clean_tap_config=True):
     logging.info(f"SUCCESS: Temporary folders for {tap} cleaned up. Arrivederci.")
 
 
-def cleanup_target(target, clean_target_config=True):
+def cleanup_target(target, clean_target_config=True, target_config_path=None):
     """
-    Cleanup temporary folders and sensitive config files after Singer Tap execution.
+    Cleanup sensitive config files after Singer Tap execution (states_in/ and states_out/
+    are shared with taps syncing concurrently, see cleanup_tap).
     """
 
-    shutil.rmtree(states_in_path, ignore_errors=True)
-    shutil.rmtree(states_out_path, ignore_errors=True)
-
     if clean_target_config:
         try:
-            os.remove(f"targets/target-{target}/config.json")
+            os.remove(target_config_path or f"targets/target-{target}/config.json")
         except OSError:
             pass
 
@@ -0,0 +1,144 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logging
+from singer_aws.main import add_sync_arguments, run_pipeline
+from singer_aws.prep_config import prefetch_configs
+from singer_aws.project_config import load_project_config
+import sys
+import time
+
+"""
+Runs many "tap | target" pipelines of a project concurrently, in a single process
+sharing project config and AWS credentials. Pipelines are defined by the `target`
+property of taps in singer_project_config.yml (or by --target argument).
+
+Number of pipelines running at the same time is limited by --concurrency (or
+`max_concurrency` in singer_project_config.yml), and number of pipelines loading
+into the same target by `max_concurrency` property of that target.
+"""
+
+DEFAULT_CONCURRENCY = 4
+
+def select_pipelines(project_config, taps=None, target=None):
+    """
+    List (tap, target) pairs to run, with tap and target names without tap-/target- prefix.
+    """
+
+    pipelines = []
+    for tap_alias, tap_config in project_config['taps'].items():
+        tap = tap_alias[len("tap-"):]
+        if taps and tap not in taps:
+            continue
+        tap_target = target or (tap_config or {}).get('target')
+        if tap_target is None:
+            if taps:
+                raise ValueError(f"ERROR: no target passed for tap-{tap} (use --target or `target` property).")
+            continue
+        pipelines.append((tap, tap_target))
+
+    unknown = set(taps or []) - set(tap for tap, _ in pipelines)
+    if unknown:
+        raise ValueError(f"ERROR: taps not found in singer_project_config.yml: {', '.join(sorted(unknown))}")
+
+    return(pipelines)
+
+
+def target_limit(project_config, target):
+    """
+    Max number of pipelines that may load into a given target concurrently (None == unlimited).
+    """
+
+    target_config = project_config['targets'].get(f"target-{target}") or {}
+    return(target_config.get('max_concurrency'))
+
+
+def run_pipelines(pipelines, project_config, args, concurrency):
+    """
+    Run pipelines in a thread pool, never starting more than `concurrency` pipelines
+    in total and more than `max_concurrency` pipelines of a single target.
+    Returns a list of (tap, target, error, duration) tuples, error being None on success.
+    """
+
+    pending = list(pipelines)
+    running = {}
+    running_per_target = {}
+    results = []
+
+    def run(tap, target):
+        # each pipeline writes its own target config, as targets are shared between taps
+        target_config_path = f"targets/target-{target}/config-tap-{tap}.json"
+        start = time.monotonic()
+        try:
+            run_pipeline(tap, target, project_config, args, target_config_path)
+        except BaseException as exc:
+            # SystemExit included, raised e.g. when state can't be fetched from S3
+            logging.error(f"ERROR: pipeline tap-{tap} | target-{target} failed: {exc!r}")
+            return(exc, time.monotonic() - start)
+        return(None, time.monotonic() - start)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while pending or running:
+
+            # start every pending pipeline which fits into global and per-target limits
+            for tap, target in list(pending):
+                if len(running) >= concurrency:
+                    break
+                limit = target_limit(project_config, target)
+                if limit is not None and running_per_target.get(target, 0) >= limit:
+                    continue
+                pending.remove((tap, target))
+                running_per_target[target] = running_per_target.get(target, 0) + 1
+                running[executor.submit(run, tap, target)] = (tap, target)
+
+            if not running:
+                # e.g. max_concurrency of their target below 1, wait() would return right away forever
+                raise ValueError(f"ERROR: pipelines {', '.join(f'tap-{tap} | target-{target}' for tap, target in pending)} "
+                                 f"can't be started (see max_concurrency of their targets).")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                tap, target = running.pop(future)
+                running_per_target[target] -= 1
+                error, duration = future.result()
+                results.append((tap, target, error, duration))
+
+    return(results)
+
+
+def main():
+
+    logging.basicConfig(level = logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Run many Singer Taps concurrently.')
+    parser.add_argument('--taps', nargs='+', help='Names of Singer Taps to run (all taps with \
+        a `target` property in singer_project_config.yml if not passed).')
+    parser.add_argument('--target', help='Name of Singer Target to run all taps into (overrides \
+        `target` property of taps).')
+    parser.add_argument('--concurrency', type=int, help=f'Max number of pipelines running at the \
+        same time (defaults to `max_concurrency` in singer_project_config.yml or {DEFAULT_CONCURRENCY}).')
+    add_sync_arguments(parser)
+    args = parser.parse_args()
+
+    project_config = load_project_config()
+    concurrency = args.concurrency or project_config.get('max_concurrency') or DEFAULT_CONCURRENCY
+
+    pipelines = select_pipelines(project_config, args.taps, args.target)
+    logging.info(f"RUNNING: {len(pipelines)} pipelines, up to {concurrency} at a time.")
+
+    # fetch configs of all taps and targets from SSM up front, 10 configs per request
+    prefetch_configs([tap for tap, _ in pipelines], set(target for _, target in pipelines), project_config)
+
+    results = run_pipelines(pipelines, project_config, args, concurrency)
+
+    print("\nSUMMARY:")
+    for tap, target, error, duration in sorted(results):
+        status = "SUCCESS" if error is None else "FAILED "
+        print(f"    {status} tap-{tap} | target-{target} ({duration:.1f}s)")
+
+    failed = [result for result in results if result[2] is not None]
+    if failed:
+        logging.error(f"ERROR: {len(failed)} of {len(results)} pipelines failed.")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
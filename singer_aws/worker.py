@@ -0,0 +1,369 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import fcntl
+import json
+import logging
+import os
+import signal
+from singer_aws.main import build_parser, run_pipeline
+from singer_aws.prep_config import prefetch_configs
+from singer_aws.project_config import load_project_config
+from singer_aws.sync_all import DEFAULT_CONCURRENCY
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+"""
+Long-running worker executing singer-aws-sync jobs from a local queue, in a single process
+keeping the interpreter, parsed project config, SSM parameters, AWS credentials and S3
+clients warm between jobs.
+
+The queue is a directory (queue/ by default) with a JSON file per job, moved between
+subdirectories as the job progresses: incoming/ -> running/ -> succeeded/ or failed/.
+A job holds the tap, its target(s) and any other singer-aws-sync arguments, e.g.:
+
+    singer-aws-worker submit --tap adwords --target redshift -- --checkpoint-seconds 300
+    singer-aws-worker run --concurrency 4
+    singer-aws-worker status
+
+Jobs are claimed by renaming their file, so a job never runs twice, even with several
+workers sharing a queue. Jobs of the same tap never run at the same time (they share its
+config and state files), in any of the workers: a worker holds a lock on queue/locks/<tap>.lock
+while a job of the tap runs. Other jobs wait in incoming/ until the tap is free. Status of the
+worker (jobs per status, durations) is kept in queue/worker.json.
+"""
+
+QUEUE_PATH = "queue"
+JOB_STATUSES = ['incoming', 'running', 'succeeded', 'failed']
+
+# seconds between checks of the queue for new jobs
+POLL_SECONDS = 2
+
+
+def now():
+    return(datetime.now(timezone.utc).isoformat())
+
+
+def queue_dirs(queue_path):
+    """
+    Create subdirectories of the queue, returning their paths by job status.
+    """
+
+    dirs = {status: os.path.join(queue_path, status) for status in JOB_STATUSES + ['locks']}
+    for path in dirs.values():
+        os.makedirs(path, exist_ok=True)
+    return(dirs)
+
+
+def write_json(path, data):
+    """
+    Atomically write a job (or status) file, so that it's never read partially written.
+    """
+
+    # unique, as several workers (and threads) may write the same file, e.g. worker.json
+    fd, path_tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=f"{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(data, fh, indent=2)
+        os.replace(path_tmp, path)
+    except BaseException:
+        try:
+            os.remove(path_tmp)
+        except OSError:
+            pass
+        raise
+
+
+def submit(queue_path, sync_args):
+    """
+    Add a job running singer-aws-sync with given arguments to the queue. Returns id of the job.
+    """
+
+    # fail on invalid arguments right away, not once the job is picked up
+    args = build_parser().parse_args(sync_args)
+
+    job_id = f"{int(time.time()*1000)}-{args.tap}-{uuid.uuid4().hex[:8]}"
+    job = {"id": job_id, "tap": args.tap, "args": sync_args, "status": "incoming", "submitted_at": now()}
+    write_json(os.path.join(queue_dirs(queue_path)['incoming'], f"{job_id}.json"), job)
+    return(job_id)
+
+
+def list_jobs(queue_path, status):
+    """
+    Jobs (oldest first) of a given status.
+    """
+
+    path = queue_dirs(queue_path)[status]
+    jobs = []
+    for name in sorted(os.listdir(path)):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(path, name)) as fh:
+                jobs.append(json.load(fh))
+        except (OSError, ValueError):
+            # moved by a worker in the meantime
+            continue
+    return(jobs)
+
+
+class Worker:
+    """
+    Claims jobs from the queue and runs them in a pool of `concurrency` threads.
+    """
+
+    def __init__(self, queue_path, concurrency, poll_seconds=POLL_SECONDS):
+        self.queue_path = queue_path
+        self.dirs = queue_dirs(queue_path)
+        self.concurrency = concurrency
+        self.poll_seconds = poll_seconds
+        self.lock = threading.Lock()
+        self.status_lock = threading.Lock()
+        self.running = {}
+        self.tap_locks = {}
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+        self.started_at = now()
+        self.counts = {"succeeded": 0, "failed": 0}
+        self.seconds = {"succeeded": 0.0, "failed": 0.0}
+
+    def requeue_orphans(self):
+        """
+        Move jobs left in running/ by workers which are not alive anymore back to incoming/.
+        A running job's worker holds the lock of its tap (see lock_tap), released by the
+        system once the worker exits, however it exits.
+        """
+
+        for job in list_jobs(self.queue_path, 'running'):
+            lock_file = self.lock_tap(job['tap'])
+            if lock_file is None:
+                # the worker running the job is alive
+                continue
+            try:
+                running_path = os.path.join(self.dirs['running'], f"{job['id']}.json")
+                if not os.path.exists(running_path):
+                    # finished in the meantime, its worker released the lock after moving it
+                    continue
+                job['status'] = 'incoming'
+                job['requeued_at'] = now()
+                write_json(os.path.join(self.dirs['incoming'], f"{job['id']}.json"), job)
+                os.remove(running_path)
+                logging.warning(f"job {job['id']} of a stopped worker {job.get('worker_pid')} is queued again.")
+            finally:
+                lock_file.close()
+
+    def queued(self):
+        """
+        Number of jobs in incoming/.
+        """
+        return(len([name for name in os.listdir(self.dirs['incoming']) if name.endswith('.json')]))
+
+    def lock_tap(self, tap):
+        """
+        Lock a tap for a job, so that no other worker sharing the queue runs a job of the tap
+        at the same time. Returns the locked file (closing it releases the lock, as does exit
+        of the worker), or None if the tap is locked by another worker.
+        """
+
+        lock_file = open(os.path.join(self.dirs['locks'], f"{tap}.lock"), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return(None)
+        return(lock_file)
+
+    def claim(self):
+        """
+        Move the oldest incoming job of a tap which isn't running yet to running/. Returns the job or None.
+        """
+
+        for name in sorted(os.listdir(self.dirs['incoming'])):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.dirs['incoming'], name)
+            try:
+                with open(path) as fh:
+                    job = json.load(fh)
+            except (OSError, ValueError):
+                continue
+            with self.lock:
+                if job['tap'] in [running['tap'] for running in self.running.values()]:
+                    continue
+            lock_file = self.lock_tap(job['tap'])
+            if lock_file is None:
+                # a job of the tap is running in another worker
+                continue
+            running_path = os.path.join(self.dirs['running'], name)
+            try:
+                os.rename(path, running_path)
+            except FileNotFoundError:
+                # claimed by another worker
+                lock_file.close()
+                continue
+            self.tap_locks[job['id']] = lock_file
+            job['status'] = 'running'
+            job['started_at'] = now()
+            job['worker_pid'] = os.getpid()
+            write_json(running_path, job)
+            return(job)
+        return(None)
+
+    def run_job(self, job):
+        """
+        Run a job like singer-aws-sync would, and move it to succeeded/ or failed/.
+        """
+
+        name = f"{job['id']}.json"
+        start = time.monotonic()
+        error = None
+        logging.info(f"RUNNING: job {job['id']}: singer-aws-sync {' '.join(job['args'])}")
+        try:
+            args = build_parser().parse_args(job['args'])
+            # reparsed only when the file changes
+            project_config = load_project_config()
+            prefetch_configs([args.tap], args.target, project_config)
+            # each job writes its own target config, as targets are shared between taps
+            target_config_path = f"targets/target-{args.target[0]}/config-tap-{args.tap}.json"
+            run_pipeline(args.tap, args.target[0], project_config, args, target_config_path,
+                         extra_targets=args.target[1:])
+        except BaseException as exc:
+            # SystemExit included, raised e.g. by invalid arguments or when state can't be fetched from S3
+            error = exc
+
+        seconds = time.monotonic() - start
+        status = 'succeeded' if error is None else 'failed'
+        job.update({"status": status, "finished_at": now(), "seconds": round(seconds, 3),
+                    "error": None if error is None else repr(error)})
+        write_json(os.path.join(self.dirs[status], name), job)
+        os.remove(os.path.join(self.dirs['running'], name))
+
+        if error is None:
+            logging.info(f"SUCCESS: job {job['id']} succeeded in {seconds:.1f}s.")
+        else:
+            logging.error(f"ERROR: job {job['id']} failed in {seconds:.1f}s: {error!r}")
+
+        with self.lock:
+            del self.running[job['id']]
+            self.tap_locks.pop(job['id']).close()
+            self.counts[status] += 1
+            self.seconds[status] += seconds
+        self.write_status()
+        self.wakeup.set()
+
+    def status(self):
+        with self.lock:
+            running = [job['id'] for job in self.running.values()]
+            finished = sum(self.counts.values())
+            return({
+                "pid": os.getpid(),
+                "started_at": self.started_at,
+                "updated_at": now(),
+                "concurrency": self.concurrency,
+                "stopping": self.stopping.is_set(),
+                "queued": self.queued(),
+                "running": running,
+                "succeeded": self.counts['succeeded'],
+                "failed": self.counts['failed'],
+                "average_seconds": round(sum(self.seconds.values()) / finished, 3) if finished else None,
+            })
+
+    def write_status(self):
+        with self.status_lock:
+            try:
+                write_json(os.path.join(self.queue_path, "worker.json"), self.status())
+            except OSError as exc:
+                # status is informative only, it mustn't stop the worker
+                logging.warning(f"status of worker {os.getpid()} wasn't written: {exc!r}")
+
+    def stop(self, *_):
+        logging.info("stopping worker: no new jobs are started, waiting for running jobs to finish.")
+        self.stopping.set()
+        self.wakeup.set()
+
+    def run(self, once=False):
+        """
+        Run jobs until stopped (or, if once is True, until the queue is empty).
+        """
+
+        logging.info(f"RUNNING: worker {os.getpid()} on {self.queue_path}/, up to {self.concurrency} jobs at a time.")
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while not self.stopping.is_set():
+                self.wakeup.clear()
+                # workers may die at any time, not only before this one started
+                self.requeue_orphans()
+                while len(self.running) < self.concurrency:
+                    job = self.claim()
+                    if job is None:
+                        break
+                    with self.lock:
+                        self.running[job['id']] = job
+                    executor.submit(self.run_job, job)
+                self.write_status()
+                if once and not self.running and self.queued() == 0:
+                    break
+                self.wakeup.wait(self.poll_seconds)
+        self.write_status()
+        logging.info(f"SUCCESS: worker {os.getpid()} stopped.")
+
+
+def main():
+
+    logging.basicConfig(level = logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Run singer-aws-sync jobs from a local queue.')
+    parser.add_argument('--queue', default=QUEUE_PATH, help=f'Directory of the queue ({QUEUE_PATH}/ by default).')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run jobs of the queue until stopped (SIGTERM/SIGINT).')
+    run_parser.add_argument('--concurrency', type=int, help=f'Max number of jobs running at the same time \
+        (defaults to `max_concurrency` in singer_project_config.yml or {DEFAULT_CONCURRENCY}).')
+    run_parser.add_argument('--poll-seconds', type=float, default=POLL_SECONDS, help='Seconds between checks \
+        of the queue for new jobs.')
+    run_parser.add_argument('--once', action='store_true', help='If passed, the worker stops once the queue is empty.')
+
+    submit_parser = subparsers.add_parser('submit', help='Add a singer-aws-sync job to the queue.')
+    submit_parser.add_argument('--tap', required=True)
+    submit_parser.add_argument('--target', action='append', required=True)
+    submit_parser.add_argument('sync_args', nargs='*', help='Other singer-aws-sync arguments (after --).')
+
+    status_parser = subparsers.add_parser('status', help='Print status of the worker and of jobs of the queue.')
+    status_parser.add_argument('--job', help='Print status of a single job.')
+
+    args = parser.parse_args()
+
+    if args.command == 'submit':
+        sync_args = ["--tap", args.tap] + [arg for target in args.target for arg in ["--target", target]]
+        print(submit(args.queue, sync_args + args.sync_args))
+
+    elif args.command == 'status':
+        if args.job:
+            for status in JOB_STATUSES:
+                for job in list_jobs(args.queue, status):
+                    if job['id'] == args.job:
+                        print(json.dumps(job, indent=2))
+                        return
+            logging.error(f"ERROR: job {args.job} not found in {args.queue}/.")
+            sys.exit(1)
+        try:
+            with open(os.path.join(args.queue, "worker.json")) as fh:
+                worker = json.load(fh)
+        except (OSError, ValueError):
+            worker = None
+        print(json.dumps({
+            "worker": worker,
+            "jobs": {status: len(list_jobs(args.queue, status)) for status in JOB_STATUSES},
+        }, indent=2))
+
+    else:
+        concurrency = args.concurrency or load_project_config().get('max_concurrency') or DEFAULT_CONCURRENCY
+        worker = Worker(args.queue, concurrency, args.poll_seconds)
+        signal.signal(signal.SIGTERM, worker.stop)
+        signal.signal(signal.SIGINT, worker.stop)
+        worker.run(once=args.once)
+
+if __name__ == '__main__':
+    main()
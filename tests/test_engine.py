@@ -0,0 +1,120 @@
+import asyncio
+from singer_aws import engine
+from singer_aws.engine import TargetFeed
+
+"""
+Tests of TargetFeed: order of messages going through the buffer and the spill file,
+waiting for room in a full buffer and waking up waiting taps when the target fails.
+"""
+
+
+class Stdin:
+    """
+    Stdin of a target that accepts messages only once `accept` is set, failing with
+    BrokenPipeError instead if `broken` is set.
+    """
+
+    def __init__(self):
+        self.written = []
+        self.accept = asyncio.Event()
+        self.broken = False
+
+    def writelines(self, lines):
+        self.written.extend(lines)
+
+    async def drain(self):
+        await self.accept.wait()
+        if self.broken:
+            raise BrokenPipeError()
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+async def settle():
+    # lets the feed's own coroutine run as far as it can
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def message(n):
+    return(f'{{"type":"RECORD","stream":"s","record":{{"id":{n}}}}}\n'.encode())
+
+
+def test_buffer_spill_drain_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, "spill_path", str(tmp_path))
+    messages = [message(n) for n in range(10)]
+    size = len(messages[0])
+
+    async def feed_messages():
+        stdin = Stdin()
+        feed = TargetFeed("target-test", stdin, buffer_bytes=2 * size, spill_bytes=100 * size)
+        for line in messages[:8]:
+            await feed.put([line], size)
+        # two messages fit into the buffer, the rest are spilled
+        assert feed.spilled == 6 * size
+        stdin.accept.set()
+        await settle()
+        # once drained, the spill file starts over and messages go to the buffer again
+        assert feed.spill_written == feed.spill_read == 0
+        for line in messages[8:]:
+            await feed.put([line], size)
+        await feed.close()
+        return(stdin, feed)
+
+    stdin, feed = asyncio.run(feed_messages())
+    assert b"".join(stdin.written) == b"".join(messages)
+    assert feed.stats()["spilled_bytes"] == 6 * size
+    assert not feed.failed
+
+
+def test_full_buffer_blocks_tap(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, "spill_path", str(tmp_path))
+    messages = [message(n) for n in range(2)]
+    size = len(messages[0])
+
+    async def feed_messages():
+        stdin = Stdin()
+        feed = TargetFeed("target-test", stdin, buffer_bytes=size)
+        await feed.put([messages[0]], size)
+        second = asyncio.create_task(feed.put([messages[1]], size))
+        await asyncio.sleep(0.01)
+        # the buffer is full until the target accepts the first message
+        assert not second.done()
+        stdin.accept.set()
+        await asyncio.wait_for(second, timeout=5)
+        await feed.close()
+        return(stdin, feed)
+
+    stdin, feed = asyncio.run(feed_messages())
+    assert stdin.written == messages
+    assert feed.spilled == 0
+    assert feed.blocked_seconds > 0
+
+
+def test_failed_target_wakes_up_tap(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, "spill_path", str(tmp_path))
+    messages = [message(n) for n in range(3)]
+    size = len(messages[0])
+
+    async def feed_messages():
+        stdin = Stdin()
+        feed = TargetFeed("target-test", stdin, buffer_bytes=size)
+        await feed.put([messages[0]], size)
+        second = asyncio.create_task(feed.put([messages[1]], size))
+        await settle()
+        assert not second.done()
+        stdin.broken = True
+        stdin.accept.set()
+        await asyncio.wait_for(second, timeout=5)
+        # messages put after the failure are discarded right away
+        await asyncio.wait_for(feed.put([messages[2]], size), timeout=5)
+        await asyncio.wait_for(feed.close(), timeout=5)
+        return(stdin, feed)
+
+    stdin, feed = asyncio.run(feed_messages())
+    assert feed.failed
+    assert stdin.written == messages[:1]
@@ -0,0 +1,122 @@
+from singer_aws import pipe
+from singer_aws.pipe import CompactStage, StateMergeStage, dumps, loads
+
+"""
+Tests of stages rewriting messages: exact messages passed on by CompactStage and
+StateMergeStage for synthetic streams of messages.
+"""
+
+
+def schema(stream, key_properties):
+    return(dumps({"type": "SCHEMA", "stream": stream, "schema": {}, "key_properties": key_properties}))
+
+
+def record(stream, id, version):
+    return(dumps({"type": "RECORD", "stream": stream, "record": {"id": id, "version": version}}))
+
+
+def state(value):
+    return(dumps({"type": "STATE", "value": value}))
+
+
+def run(stage, lines):
+    output = []
+    for line in lines:
+        output.extend(stage.process(line))
+    output.extend(stage.close())
+    return(output)
+
+
+MESSAGES = [
+    schema("users", ["id"]),
+    schema("events", []),
+    record("users", 1, 1),
+    record("users", 2, 1),
+    record("events", 1, 1),
+    record("users", 1, 2),
+    record("users", 3, 1),
+    record("users", 2, 2),
+    state({"bookmarks": {"users": 1}}),
+    record("users", 1, 3),
+    record("users", 1, 4),
+]
+
+# latest versions of keys, in the order of their latest versions, released at every
+# message other than a RECORD; records of streams without keys are passed on right away
+COMPACTED = [
+    schema("users", ["id"]),
+    schema("events", []),
+    record("events", 1, 1),
+    record("users", 1, 2),
+    record("users", 3, 1),
+    record("users", 2, 2),
+    state({"bookmarks": {"users": 1}}),
+    record("users", 1, 4),
+]
+
+
+def test_compact_keeps_latest_versions_until_state():
+    stage = CompactStage("tap-test")
+    assert run(stage, MESSAGES) == COMPACTED
+    assert stage.summary() == {
+        "records": 7,
+        "superseded_records": 3,
+        "bytes_saved": sum(len(line) for line in [MESSAGES[2], MESSAGES[3], MESSAGES[9]]),
+        "spilled_bytes": 0,
+        "early_flushes": 0,
+    }
+
+
+def test_compact_spilled_records_keep_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipe, "spill_path", str(tmp_path))
+    # a single record fits in memory, the rest are spilled
+    stage = CompactStage("tap-test", memory_bytes=len(MESSAGES[2]), spill_bytes=1024 * 1024)
+    assert run(stage, MESSAGES) == COMPACTED
+    assert stage.spilled > 0
+    assert stage.early_flushes == 0
+
+
+def test_compact_flushes_early_without_spill():
+    stage = CompactStage("tap-test", memory_bytes=2 * len(MESSAGES[2]))
+    assert run(stage, MESSAGES) == [
+        schema("users", ["id"]),
+        schema("events", []),
+        record("events", 1, 1),
+        # the third held record doesn't fit, held ones are passed on first
+        record("users", 2, 1),
+        record("users", 1, 2),
+        record("users", 3, 1),
+        record("users", 2, 2),
+        state({"bookmarks": {"users": 1}}),
+        record("users", 1, 4),
+    ]
+    assert stage.early_flushes == 1
+
+
+def test_state_merge_on_top_of_base_state():
+    stage = StateMergeStage("tap-test", base_state={
+        "bookmarks": {"users": {"updated_at": "2020-01-01"}, "events": {"updated_at": "2020-01-01"}},
+        "currently_syncing": "users",
+        })
+    lines = [
+        record("users", 1, 1),
+        state({"bookmarks": {"users": {"updated_at": "2020-02-01"}}, "currently_syncing": "users"}),
+        state({"bookmarks": {"orders": {"id": 10}}}),
+    ]
+    output = [stage.process(line) for line in lines]
+
+    assert output[0] == [lines[0]]
+    assert [loads(line) for line in output[1] + output[2]] == [
+        {"type": "STATE", "value": {
+            "bookmarks": {"users": {"updated_at": "2020-02-01"}, "events": {"updated_at": "2020-01-01"}},
+            "currently_syncing": None,
+        }},
+        {"type": "STATE", "value": {
+            "bookmarks": {
+                "users": {"updated_at": "2020-02-01"},
+                "events": {"updated_at": "2020-01-01"},
+                "orders": {"id": 10},
+            },
+            "currently_syncing": None,
+        }},
+    ]